@@ -23,5 +23,21 @@ def run() -> None:
     asyncio.run(_run_main(token=settings.FILMSWAP_TOKEN))
 
 
+@main.command(short_help="restore a snapshot")
+@click.argument("SNAPSHOT", type=click.Path(exists=True, dir_okay=False))
+@click.argument("OUTPUT", type=click.Path(exists=False, dir_okay=False))
+def restore_snapshot(snapshot: str, output: str) -> None:
+    """
+    Reconstruct the database as of SNAPSHOT (a .sqlite or .delta.jsonl.gz file
+    in the backups directory) into OUTPUT
+    """
+    from .db import restore_snapshot
+
+    try:
+        restore_snapshot(snapshot, output)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
 if __name__ == "__main__":
     main(prog_name="filmswap")
@@ -10,29 +10,26 @@ from gettext import gettext as _
 from .db import (
     Swap,
     SwapPeriod,
-    check_active_user,
+    UserContext,
+    load_user_context,
     set_letterboxd,
     review_my_gift_embed,
     review_my_letter_embed,
     receive_gift_embed,
-    get_santa,
-    get_giftee,
     read_giftee_letter,
-    set_gift,
-    user_has_letter,
-    has_set_gift,
     set_gift_done,
     backup_all_letters,
-    set_letter,
+    take_snapshot,
     leave_swap,
-    has_giftee,
+    run_db,
+    run_db_read,
 )
 from .settings import settings, Environment
-from .manage import Manage, JoinSwapButton, update_usernames
+from .manage import Manage, JoinSwapButton, MemberUpdateBatcher, update_usernames
+from .fanout import OutboxWorker
+from .dm_commands import dispatch
 from ._types import ClientT
 
-MSG_DESCRIPTION_LIMIT = 4000
-
 
 def help_embed() -> discord.Embed:
     embed = discord.Embed(title="Help", description=_("Filmswap Help"))
@@ -104,6 +101,8 @@ def help_embed() -> discord.Embed:
 
 
 async def background_tasks(bot: discord.Client) -> None:
+    # names are updated from on_member_update/on_user_update as they change, this
+    # is just a reconciliation pass, for any changes made while the bot was down
     while True:
         gld = bot.get_guild(settings.GUILD_ID)
         if gld is None:
@@ -112,7 +111,17 @@ async def background_tasks(bot: discord.Client) -> None:
             )
             return
         await update_usernames(gld)
-        await asyncio.sleep(60 * 60 * 24)
+        await asyncio.sleep(60 * 60 * settings.USERNAME_RECONCILE_INTERVAL)
+
+
+async def snapshot_tasks() -> None:
+    # only writes the rows which changed since the last snapshot, so this is cheap
+    while True:
+        try:
+            await run_db(take_snapshot)
+        except Exception as e:
+            logger.exception(f"Error taking snapshot: {e}", exc_info=True)
+        await asyncio.sleep(60 * 60 * settings.SNAPSHOT_INTERVAL)
 
 
 def create_bot() -> discord.Client:
@@ -157,20 +166,22 @@ def create_bot() -> discord.Client:
                 return True
         return False
 
-    async def not_active_user(ctx: discord.Interaction[ClientT] | commands.Context) -> bool:  # type: ignore[type-arg]
+    async def active_user_context(ctx: discord.Interaction[ClientT] | commands.Context) -> UserContext | None:  # type: ignore[type-arg]
         """
-        returns True if user is not active, False if user is active
+        returns the users context if they are active, None (after telling them why) if they are not
         """
         if isinstance(ctx, commands.Context):
-            if error := check_active_user(ctx.author.id):
+            user_ctx = await run_db_read(load_user_context, ctx.author.id)
+            if error := user_ctx.error:
                 await ctx.reply(error)
-                return True
+                return None
         else:
             assert isinstance(ctx, discord.Interaction)
-            if error := check_active_user(ctx.user.id):
+            user_ctx = await run_db_read(load_user_context, ctx.user.id)
+            if error := user_ctx.error:
                 await ctx.response.send_message(error, ephemeral=True)
-                return True
-        return False
+                return None
+        return user_ctx
 
     @bot.tree.command(name="review-letter", description="Review your letter")  # type: ignore[arg-type]
     async def review_letter(interaction: discord.Interaction[ClientT]) -> None:
@@ -181,10 +192,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_ctx := await active_user_context(interaction)) is None:
             return
 
-        embed = review_my_letter_embed(interaction.user.id)
+        embed = review_my_letter_embed(interaction.user.id, context=user_ctx)
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @bot.tree.command(  # type: ignore[arg-type]
@@ -199,7 +210,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         await interaction.response.send_message(
@@ -221,7 +232,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         await interaction.response.send_message(
@@ -241,7 +252,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         await interaction.response.send_message(
@@ -258,10 +269,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_ctx := await active_user_context(interaction)) is None:
             return
 
-        embed = review_my_gift_embed(interaction.user.id)
+        embed = review_my_gift_embed(interaction.user.id, context=user_ctx)
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @bot.tree.command(  # type: ignore[arg-type]
@@ -276,7 +287,7 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         # prompt the user to set their gift
@@ -295,10 +306,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_ctx := await active_user_context(interaction)) is None:
             return
 
-        gift = receive_gift_embed(interaction.user.id)
+        gift = receive_gift_embed(interaction.user.id, context=user_ctx)
         await interaction.response.send_message(embed=gift, ephemeral=True)
 
     @bot.tree.command(name="read", description="Read the letter from your giftee")  # type: ignore[arg-type]
@@ -310,10 +321,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_ctx := await active_user_context(interaction)) is None:
             return
 
-        letter = read_giftee_letter(interaction.user.id)
+        letter = read_giftee_letter(interaction.user.id, context=user_ctx)
         await interaction.response.send_message(embed=letter, ephemeral=True)
 
     @bot.tree.command(name="leave", description=_("Leave the film swap"))  # type: ignore[arg-type]
@@ -332,10 +343,10 @@ def create_bot() -> discord.Client:
             )
             return
 
-        if await not_active_user(interaction):
+        if (user_ctx := await active_user_context(interaction)) is None:
             return
 
-        if Swap.get_swap_period() != SwapPeriod.JOIN:
+        if user_ctx.period != SwapPeriod.JOIN:
             logger.info(
                 f"User {interaction.user.id} {interaction.user.display_name} tried to leave the swap but it's not the JOIN period"
             )
@@ -346,7 +357,7 @@ def create_bot() -> discord.Client:
             return
 
         try:
-            leave_swap(interaction.user.id)
+            await run_db(leave_swap, interaction.user.id)
         except RuntimeError as e:
             return await interaction.response.send_message(
                 f"Error: {e}", ephemeral=True
@@ -366,10 +377,10 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if (user_ctx := await active_user_context(interaction)) is None:
             return
 
-        if Swap.get_swap_period() == SwapPeriod.JOIN:
+        if user_ctx.period == SwapPeriod.JOIN:
             logger.info(
                 f"User {interaction.user.id} {interaction.user.display_name} tried to mark their gift as watched during the JOIN period"
             )
@@ -382,7 +393,7 @@ def create_bot() -> discord.Client:
             return
 
         try:
-            set_gift_done(interaction.user.id)
+            await run_db(set_gift_done, interaction.user.id)
         except RuntimeError as e:
             return await interaction.response.send_message(
                 f"Error: {e}", ephemeral=True
@@ -403,11 +414,11 @@ def create_bot() -> discord.Client:
         if await error_if_not_in_dm(interaction):
             return
 
-        if await not_active_user(interaction):
+        if await active_user_context(interaction) is None:
             return
 
         try:
-            set_letterboxd(interaction.user.id, username)
+            await run_db(set_letterboxd, interaction.user.id, username)
         except RuntimeError as e:
             return await interaction.response.send_message(
                 f"Error: {e}", ephemeral=True
@@ -437,253 +448,7 @@ def create_bot() -> discord.Client:
         ):
             return
 
-        content = message.content.strip()
-        if content.startswith(">letter"):
-            logger.info(f"User {message.author.id} setting letter")
-
-            if error := check_active_user(message.author.id):
-                await message.author.send(error)
-                return
-
-            if Swap.get_swap_period() != SwapPeriod.JOIN:
-                logger.info(
-                    f"User {message.author.id} tried to set letter but it's not the JOIN period"
-                )
-
-                if user_has_letter(message.author.id):
-                    # already has letter, check if they are allowed to change it right now
-                    await message.author.send(
-                        "Sorry, you can't change your letter right now. Wait till the beginning of the next swap to change it.\nIf you want to review your letter, you can use `/review-letter`",
-                    )
-                    return
-
-            letter_contents = content[len(">letter") :].strip()
-
-            if not letter_contents:
-                logger.info(
-                    f"User {message.author.id} tried to set letter but didn't provide any text"
-                )
-                await message.author.send(
-                    _(
-                        "Use `>letter [text]` to set your letter, where [text] is what kinds of films you like/dislike/want from your santa. If you have a letterboxd/imdb you can include that as well"
-                    ),
-                )
-                return
-
-            logger.info(f"User {message.author.id} setting letter to {letter_contents}")
-
-            try:
-                set_letter(message.author.id, letter_contents)
-            except AssertionError:
-                await message.author.send(
-                    f"Sorry, your letter is too long. It must be less than {MSG_DESCRIPTION_LIMIT} characters (it is currently {len(letter_contents)} characters)"
-                )
-                return
-            await message.reply("Your letter has been set, your santa will see:")
-            await message.reply(embed=review_my_letter_embed(message.author.id))
-        elif content.startswith(">submit"):
-            logger.info(f"User {message.author.id} setting gift")
-
-            if error := check_active_user(message.author.id):
-                await message.author.send(error)
-                return
-
-            if not has_giftee(message.author.id):
-                logger.info(
-                    f"User {message.author.id} tried to set gift but they don't have a giftee"
-                )
-                await message.author.send(
-                    "Sorry, you can't set your gift until you've been assigned a giftee",
-                )
-                return
-
-            current_period = Swap.get_swap_period()
-            if current_period == SwapPeriod.JOIN:
-                logger.info(
-                    f"User {message.author.id} tried to set gift but its currently JOIN period"
-                )
-                # already has gift, check if they are allowed to change it right now
-                await message.author.send(
-                    "Sorry, you can't change your gift right now. Wait till the next 'swap' period starts to set your gift",
-                )
-                return
-
-            assert (
-                current_period == SwapPeriod.SWAP or current_period == SwapPeriod.WATCH
-            )
-            # check if they've already submitted a gift this swap
-            # we should not allow people who have already submitted to change during the swap period,
-            # but if they haven't submitted yet, they can submit at any time (to allow latecomers to join later)
-            if current_period == SwapPeriod.WATCH and has_set_gift(message.author.id):
-                logger.info(
-                    f"User {message.author.id} tried to set gift but the WATCH period has already started, and they've already set a gift"
-                )
-                # already has gift, check if they are allowed to change it right now
-                await message.author.send(
-                    "Sorry, you can't change your gift right now. If you need to communicate with your giftee, you can use >write-giftee to send them a message.\nIf you want to review the gift you sent, use `/review-gift`",
-                )
-                return
-
-            # this is only possible if its the swap period, or if its the watch period and they haven't set a gift yet
-            # that couldve happened if a user was banned, or they forgot to set it but >write-giftee'd their giftee
-            gift_contents = content[len(">submit") :].strip()
-
-            if not gift_contents:
-                logger.info(
-                    f"User {message.author.id} tried to set gift but didn't provide any text"
-                )
-                await message.author.send(
-                    _(
-                        "Use `>submit [text]` to submit your gift, where [text] is your gift/film recommendation"
-                    ),
-                )
-                return
-
-            logger.info(f"User {message.author.id} setting gift to {gift_contents}")
-
-            try:
-                set_gift(message.author.id, gift_contents)
-            except AssertionError:
-                await message.author.send(
-                    f"Sorry, your gift is too long. It must be less than {MSG_DESCRIPTION_LIMIT} characters (it is currently {len(gift_contents)} characters)"
-                )
-                return
-            await message.reply(
-                "Your gift has been set, when the watch period starts your giftee will see:"
-            )
-            await message.reply(embed=review_my_gift_embed(message.author.id))
-            await message.reply(
-                "Since you can change your gift by running /submit again before the SWAP period ends, your giftee does not receive their gift immediately.\nIf you're confident in your gift or want to send it early, you can also use >write-giftee to send it to your giftee early"
-            )
-
-        elif content.startswith(">write-santa"):
-            logger.info(f"User {message.author.id} sending message to santa")
-
-            if error := check_active_user(message.author.id):
-                await message.author.send(error)
-                return
-
-            santa = get_santa(message.author.id)
-
-            if santa is None:
-                logger.info(
-                    f"User {message.author.id} tried to send message to santa but they don't have a santa"
-                )
-                await message.author.send(
-                    "You can only send a message to your santa after you've been assigned one"
-                )
-                return
-
-            message_contents = content[len(">write-santa") :].strip()
-
-            if not message_contents:
-                logger.info(
-                    f"User {message.author.id} tried to send message to santa but didn't provide any text"
-                )
-                await message.author.send(
-                    "Use >write-santa [text] to send a message to your santa, where [text] is your message"
-                )
-                return
-
-            if len(message_contents) > MSG_DESCRIPTION_LIMIT:
-                logger.info(
-                    f"User {message.author.id} tried to send message to santa but their message was too long"
-                )
-                await message.author.send(
-                    f"Sorry, your message is too long. It must be less than {MSG_DESCRIPTION_LIMIT} characters (it is currently {len(message_contents)} characters)"
-                )
-                return
-
-            assert santa is not None
-
-            try:
-                santa_user = await bot.fetch_user(santa.user_id)
-            except Exception:
-                logger.info(
-                    f"User {message.author.id} tried to send message to santa but their santa's ID {santa.user_id} is invalid"
-                )
-                await message.author.send(
-                    "There was an error messaging your santa, could not associate their ID with a discord account."
-                )
-                return
-            else:
-                logger.info(
-                    f"User {message.author.id} {message.author.display_name} sending message to santa {santa.user_id} {santa.name} {message_contents}"
-                )
-                embed = discord.Embed(
-                    title="Your giftee sent you a message", description=message_contents
-                )
-                embed.set_footer(text="To reply, use >write-giftee [text]")
-                await santa_user.send(embed=embed)
-
-                await message.author.send("Your message has been sent")
-
-        elif content.startswith(">write-giftee"):
-            logger.info(f"User {message.author.id} sending message to giftee")
-
-            if error := check_active_user(message.author.id):
-                await message.author.send(error)
-                return
-
-            giftee = get_giftee(message.author.id)
-
-            if giftee is None:
-                logger.info(
-                    f"User {message.author.id} tried to send message to giftee but they don't have a giftee"
-                )
-                await message.author.send(
-                    "You can only send a message to your giftee after you've been assigned one"
-                )
-                return
-
-            message_contents = content[len(">write-giftee") :].strip()
-
-            if not message_contents:
-                logger.info(
-                    f"User {message.author.id} tried to send message to giftee but didn't provide any text"
-                )
-                await message.author.send(
-                    "Use >write-giftee [text] to send a message to your giftee, where [text] is your message"
-                )
-                return
-
-            if len(message_contents) > MSG_DESCRIPTION_LIMIT:
-                logger.info(
-                    f"User {message.author.id} tried to send message to giftee but their message was too long"
-                )
-                await message.author.send(
-                    f"Sorry, your message is too long. It must be less than {MSG_DESCRIPTION_LIMIT} characters (it is currently {len(message_contents)} characters)"
-                )
-                return
-
-            assert giftee is not None
-            try:
-                giftee_user = await bot.fetch_user(giftee.user_id)
-            except Exception:
-                logger.info(
-                    f"User {message.author.id} tried to send message to giftee but their giftee's ID {giftee.user_id} is invalid"
-                )
-                await message.author.send(
-                    "There was an error messaging your giftee, could not associate their ID with a discord account."
-                )
-                return
-            else:
-                logger.info(
-                    f"User {message.author.id} {message.author.display_name} sending message to giftee {giftee.user_id} {giftee.name} {message_contents}"
-                )
-                embed = discord.Embed(
-                    title="Your santa sent you a message", description=message_contents
-                )
-                embed.set_footer(text="To reply, use >write-santa [text]")
-                await giftee_user.send(embed=embed)
-                await message.author.send("Your message has been sent")
-        elif content.startswith(">"):
-            logger.info(
-                f"User {message.author.id} {message.author.display_name} sent unknown command {content}"
-            )
-            await message.author.send(
-                "Unknown command. Use `/help` to see a list of commands"
-            )
+        await dispatch(bot, message)
 
     @bot.tree.command()  # type: ignore[arg-type]
     async def help(interaction: discord.Interaction[ClientT]) -> None:
@@ -695,7 +460,7 @@ def create_bot() -> discord.Client:
     @bot.event
     async def setup_hook() -> None:
         logger.info("Setting up persistent join button")
-        latest_swap_msg_id = Swap.get_join_button_message_id()
+        latest_swap_msg_id = await run_db_read(Swap.get_join_button_message_id)
         if latest_swap_msg_id is None:
             logger.info("No join button message ID found")
         else:
@@ -704,12 +469,38 @@ def create_bot() -> discord.Client:
         join_view._bot = bot  # type: ignore
         bot.add_view(join_view, message_id=latest_swap_msg_id)
 
+    member_updates = MemberUpdateBatcher()
+
+    @bot.event
+    async def on_member_update(before: discord.Member, after: discord.Member) -> None:
+        if after.guild.id != settings.GUILD_ID:
+            return
+        if before.display_name != after.display_name:
+            member_updates.name_changed(after.id, after.display_name)
+
+    @bot.event
+    async def on_user_update(before: discord.User, after: discord.User) -> None:
+        # changing global/username changes the display name, if they have no server nickname
+        gld = bot.get_guild(settings.GUILD_ID)
+        if gld is None:
+            return
+        member = gld.get_member(after.id)
+        if member is not None and member.nick is None:
+            member_updates.name_changed(after.id, member.display_name)
+
+    @bot.event
+    async def on_member_remove(member: discord.Member) -> None:
+        if member.guild.id != settings.GUILD_ID:
+            return
+        member_updates.member_removed(member.id)
+
     @bot.event
     async def on_ready() -> None:
         logger.info(f"Logged in as {bot.user}")
         logger.info(
             f"Period post hook is {'enabled' if settings.PERIOD_POST_HOOK else 'disabled'}"
         )
+        logger.info(f"Using sqlite profile {settings.SQLITE_PROFILE.value}")
         if settings.GUILD_ID == -1:
             logger.warning("No guild ID specified, cannot register commands")
             return
@@ -720,8 +511,10 @@ def create_bot() -> discord.Client:
             )
             return
 
+        outbox = OutboxWorker(bot)
         manager = Manage(name=_("filmswap-manage"), description="Manage swaps")
         manager._bot = bot  # type: ignore
+        manager._outbox = outbox  # type: ignore
 
         os.makedirs(settings.BACKUP_DIR, exist_ok=True)
 
@@ -737,8 +530,11 @@ def create_bot() -> discord.Client:
 
         await bot.tree.sync()
 
-        backup_all_letters()
+        await run_db(backup_all_letters)
         logger.info("Starting background tasks...")
+        outbox.start()
         bot.loop.create_task(background_tasks(bot))
+        if settings.SNAPSHOT_INTERVAL > 0:
+            bot.loop.create_task(snapshot_tasks())
 
     return bot
@@ -1,35 +1,61 @@
 from __future__ import annotations
 import json
+import gzip
 import random
+import shutil
+import hashlib
+import datetime
 import os
 import enum
 import time
-from typing import Any
+import logging
+import asyncio
+import functools
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, TypeVar, ParamSpec
 
 import discord
 
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
     Integer,
     String,
+    Text,
     Boolean,
     Enum,
+    Index,
+    text,
+    select,
+    update,
+    bindparam,
+    exists,
+    literal,
+    insert,
 )
-from sqlite_backup.core import sqlite_backup
 from sqlalchemy.sql import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy import DateTime
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import MetaData
+from sqlalchemy.engine import Engine
 from logzero import logger  # type: ignore[import]
 
 
 metadata = MetaData()
 Base = declarative_base(metadata=metadata)
 
-from .settings import settings
+from .settings import settings, SqliteProfile, SQLITE_PROFILE_PRAGMAS
+
+# how many santa/giftee assignments are sent to sqlite per executemany when matching
+MATCH_BATCH_SIZE = 5000
 
 
 class SwapPeriod(enum.Enum):
@@ -38,6 +64,122 @@ class SwapPeriod(enum.Enum):
     WATCH = "WATCH"
 
 
+# the swap row only changes when an admin runs set-period, set-channel or
+# send-join-message, so it is kept in memory. anything that writes to it
+# calls Swap.invalidate_cache after committing
+_swap_cache: Swap | None = None
+_swap_cache_generation = 0
+_swap_cache_lock = threading.Lock()
+
+
+class EmbedCache:
+    """
+    LRU cache for user contexts and the embeds rendered from them, so repeated
+    /read, /receive and /review-* calls don't have to query the database
+
+    Entries are keyed by (user_id, kind), and store the version they were built at.
+    A users version is bumped when their row changes (which also changes what
+    their santa/giftee see), and changes that affect everyone (period, matching,
+    names) bump the epoch, which makes every cached entry stale
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._epoch = 0
+        self._versions: dict[int, int] = {}
+        self._entries: OrderedDict[tuple[int, str], tuple[tuple[int, int], Any]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def version(self, user_id: int) -> tuple[int, int]:
+        with self._lock:
+            return self._epoch, self._versions.get(user_id, 0)
+
+    def get(self, user_id: int, kind: str, version: tuple[int, int]) -> Any | None:
+        with self._lock:
+            entry = self._entries.get((user_id, kind))
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((user_id, kind))
+            self.hits += 1
+            return entry[1]
+
+    def put(
+        self, user_id: int, kind: str, version: tuple[int, int], value: Any
+    ) -> None:
+        with self._lock:
+            self._entries[(user_id, kind)] = (version, value)
+            self._entries.move_to_end((user_id, kind))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def bump(self, *user_ids: int | None) -> None:
+        """
+        call after committing a change to these users rows
+        """
+        with self._lock:
+            for user_id in user_ids:
+                if user_id is not None:
+                    self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def clear(self) -> None:
+        """
+        call after committing a change which could affect any user
+        """
+        with self._lock:
+            self._epoch += 1
+            self._versions.clear()
+            self._entries.clear()
+
+    def stats(self) -> str:
+        with self._lock:
+            total = self.hits + self.misses
+            rate = self.hits / total * 100 if total else 0
+            return f"{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {len(self._entries)}/{self.maxsize} entries"
+
+
+embed_cache = EmbedCache(settings.EMBED_CACHE_SIZE)
+
+
+class ParticipantIds:
+    """
+    the user ids in the swap, kept in memory so gateway events (name changes,
+    members leaving) for everyone else in the server can be dropped without a query
+
+    this is kept up to date by join_swap/leave_swap/ban_user, and reset from the
+    database by the username reconciliation pass. until then, nobody is ruled out
+    """
+
+    def __init__(self) -> None:
+        self._ids: set[int] | None = None
+        self._lock = threading.Lock()
+
+    def reset(self, user_ids: Iterable[int]) -> None:
+        with self._lock:
+            self._ids = set(user_ids)
+
+    def add(self, user_id: int) -> None:
+        with self._lock:
+            if self._ids is not None:
+                self._ids.add(user_id)
+
+    def discard(self, user_id: int) -> None:
+        with self._lock:
+            if self._ids is not None:
+                self._ids.discard(user_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        with self._lock:
+            return self._ids is None or user_id in self._ids
+
+
+participants = ParticipantIds()
+
+
 # probably just gonna be a singleton, run multiple instances of the bot for additional swaps
 class Swap(Base):
     __tablename__ = "swaps"
@@ -50,20 +192,47 @@ class Swap(Base):
 
     @staticmethod
     def list_swaps() -> list[Swap]:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
             return session.query(Swap).all()  # type: ignore[no-any-return]
 
+    @staticmethod
+    def _load(session: Session) -> Swap:
+        try:
+            return session.query(Swap).filter_by().limit(1).one()  # type: ignore[no-any-return]
+        except NoResultFound as e:
+            raise RuntimeError("No swap configured") from e
+
     @staticmethod
     def get_swap() -> Swap:
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            try:
-                return session.query(Swap).filter_by().limit(1).one()  # type: ignore[no-any-return]
-            except NoResultFound as e:
-                raise RuntimeError("No swap configured") from e
+        """
+        returns the (cached) swap. this is detached from any session, so
+        to modify the swap, load it in a session with Swap._load instead
+        """
+        global _swap_cache
+        with _swap_cache_lock:
+            if _swap_cache is not None:
+                return _swap_cache
+            generation = _swap_cache_generation
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            swap = Swap._load(session)
+        with _swap_cache_lock:
+            # if this was invalidated while we were reading, what we read may be stale
+            if generation == _swap_cache_generation:
+                _swap_cache = swap
+        return swap
+
+    @staticmethod
+    def invalidate_cache() -> None:
+        global _swap_cache, _swap_cache_generation
+        with _swap_cache_lock:
+            _swap_cache = None
+            _swap_cache_generation += 1
+        # embeds depend on the period
+        embed_cache.clear()
 
     @staticmethod
     def create_swap() -> Swap:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
             try:
                 swap = session.query(Swap).filter_by().limit(1).one()
                 raise RuntimeError("Swap is already configured")
@@ -72,16 +241,18 @@ class Swap(Base):
             swap = Swap()
             session.add(swap)
             session.commit()
+        Swap.invalidate_cache()
         return swap  # type: ignore[no-any-return]
 
     @staticmethod
     def save_join_button_message_id(message_id: int) -> None:
         logger.info(f"Saving join button message id {message_id}")
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            swap = Swap.get_swap()
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            swap = Swap._load(session)
             swap.join_button_message_id = message_id
             session.add(swap)
             session.commit()
+        Swap.invalidate_cache()
 
     @staticmethod
     def get_join_button_message_id() -> int | None:
@@ -99,55 +270,85 @@ class Swap(Base):
 
     @staticmethod
     def match_users() -> None:
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            # find users where they have letters, and have no matched user
-            users = session.query(SwapUser).filter_by(santa_id=None).all()
-            logger.info(f"Found {len(users)} users with no santa")
-            users = [u for u in users if u.letter is not None]
-            logger.info(f"Found {len(users)} users with letters, with no santa")
-            if len(users) < 2:
-                raise RuntimeError(
-                    f"Cannot match users without at least 2 unmatched users, currently have {len(users)} who have letters, but have no santa"
-                )
-
-            random.shuffle(users)
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            Swap._match_users(session)
+            session.commit()
+        embed_cache.clear()
 
-            logger.info(
-                f"Shuffled users, random order: {[f'{u.user_id} {u.name}' for u in users]}"
+    @staticmethod
+    def _match_users(session: Session) -> None:
+        """
+        matches users in session, without committing, so this can be part of a larger transaction
+        """
+        # find users where they have letters, and have no matched user
+        # this only reads the ids (covered by ix_swap_users_with_letter), into compact arrays
+        ids = array("q")
+        user_ids = array("q")
+        for row_id, user_id in (
+            session.query(SwapUser.id, SwapUser.user_id)
+            .filter_by(santa_id=None)
+            .filter(SwapUser.letter.is_not(None))  # type: ignore[attr-defined]
+        ):
+            ids.append(row_id)
+            user_ids.append(user_id)
+        logger.info(f"Found {len(ids)} users with letters, with no santa")
+        if len(ids) < 2:
+            raise RuntimeError(
+                f"Cannot match users without at least 2 unmatched users, currently have {len(ids)} who have letters, but have no santa"
             )
 
-            # after shuffling the list, each person gets assigned the person in front of them as their giftee, and behind them as their santa
-            for i, user in enumerate(users):
-                user_before = users[i - 1]
-                user_after = users[(i + 1) % len(users)]
+        order = array("q", range(len(ids)))
+        random.shuffle(order)
 
-                logger.info(
-                    f"For user {user.user_id}, santa is {user_before.user_id}, giftee is {user_after.user_id}"
-                )
-
-                user.santa_id = user_before.user_id
-                user.giftee_id = user_after.user_id
-                session.add(user)
+        # only build the (possibly very large) list if its going to be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Shuffled users, random order: {[user_ids[i] for i in order]}"
+            )
 
-            session.commit()
+        # after shuffling the list, each person gets assigned the person in front of them as their giftee, and behind them as their santa
+        stmt = (
+            update(SwapUser.__table__)  # type: ignore[attr-defined]
+            .where(SwapUser.__table__.c.id == bindparam("row_id"))  # type: ignore[attr-defined]
+            .values(santa_id=bindparam("santa"), giftee_id=bindparam("giftee"))
+        )
+        count = len(order)
+        for start in range(0, count, MATCH_BATCH_SIZE):
+            session.execute(
+                stmt,
+                [
+                    {
+                        "row_id": ids[order[i]],
+                        "santa": user_ids[order[i - 1]],
+                        "giftee": user_ids[order[(i + 1) % count]],
+                    }
+                    for i in range(start, min(start + MATCH_BATCH_SIZE, count))
+                ],
+            )
+        logger.info(f"Matched {count} users")
 
     @staticmethod
     def unmatch_users() -> None:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
             # set all users santa_id and giftee_id to None
-            users = session.query(SwapUser).all()
-            for user in users:
-                logger.info(f"Unmatching user {user.user_id}")
-                user.santa_id = None
-                user.giftee_id = None
-                session.add(user)
+            count = session.query(SwapUser).update(
+                {"santa_id": None, "giftee_id": None}, synchronize_session=False
+            )
             session.commit()
+        embed_cache.clear()
+        logger.info(f"Unmatched {count} users")
 
     @staticmethod
-    def set_swap_period(period: SwapPeriod) -> str | None:
+    def set_swap_period(
+        period: SwapPeriod, outbox_batch: str | None = None
+    ) -> str | None:
+        """
+        if outbox_batch is given, the letters (SWAP)/gifts (WATCH) for every user
+        are queued in the outbox as part of the same transaction as the period change
+        """
         msg: str | None = None
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            swap = Swap.get_swap()
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            swap = Swap._load(session)
             if period == SwapPeriod.SWAP:
                 logger.info("Running db logic for SWAP period")
                 if swap.swap_channel_discord_id is None:
@@ -155,32 +356,45 @@ class Swap(Base):
                         "Cannot set swap period to swap without a swap channel, run the 'set-channel' command"
                     )
                 try:
-                    Swap.match_users()
+                    Swap._match_users(session)
                     msg = "Matched all users with their giftee/santas"
                 except RuntimeError as e:
                     msg = f"Warning: couldn't match users -- {e}"
 
                 # set done_watching to False for all users
-                users = session.query(SwapUser).all()
-                logger.info(f"Setting done_watching to False for {len(users)} users")
-                for user in users:
-                    user.done_watching = False
-                    session.add(user)
+                count = session.query(SwapUser).update(
+                    {"done_watching": False}, synchronize_session=False
+                )
+                logger.info(f"Set done_watching to False for {count} users")
             elif period == SwapPeriod.JOIN:
-                snapshot_database()
+                # a full snapshot, so the export has everyone at the end of the swap
+                backup_path = take_snapshot(full=True)
+                assert backup_path is not None
+                # the export reads from the backup, so it can run after the
+                # users are unmatched below, without holding up the writer thread
+                _reader_executor.submit(_export_snapshot_logged, backup_path)
                 logger.info("Running db logic for JOIN period")
                 # need to remove all santa_id/giftee_id's back to null, and remove gifts from users
-                users = session.query(SwapUser).all()
-                for user in users:
-                    logger.info(f"Unmatching user {user.user_id}")
-                    user.santa_id = None
-                    user.giftee_id = None
-                    user.gift = None
-                    session.add(user)
+                count = session.query(SwapUser).update(
+                    {"santa_id": None, "giftee_id": None, "gift": None},
+                    synchronize_session=False,
+                )
+                logger.info(f"Unmatched {count} users and removed their gifts")
+
+            if outbox_batch is not None and period in (
+                SwapPeriod.SWAP,
+                SwapPeriod.WATCH,
+            ):
+                _enqueue_messages(
+                    session,
+                    outbox_batch,
+                    ((u, None, e) for u, e in _period_messages(session, period)),
+                )
 
             swap.period = period  # type: ignore[assignment]
             session.add(swap)
             session.commit()
+            Swap.invalidate_cache()
 
             logger.info(f"Done setting swap period to {period}")
 
@@ -188,11 +402,12 @@ class Swap(Base):
 
     @staticmethod
     def set_swap_channel(channel_id: int) -> None:
-        with Session(engine) as session:  # type: ignore[attr-defined]
-            swap = Swap.get_swap()
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            swap = Swap._load(session)
             swap.swap_channel_discord_id = channel_id
             session.add(swap)
             session.commit()
+        Swap.invalidate_cache()
 
     @staticmethod
     def get_swap_period() -> SwapPeriod:
@@ -203,9 +418,19 @@ class Swap(Base):
 
 class SwapUser(Base):
     __tablename__ = "swap_users"
+    __table_args__ = (
+        # matching only looks at users who have set a letter and have no santa,
+        # this covers that query without reading the (large) letter/gift columns
+        Index(
+            "ix_swap_users_with_letter",
+            "santa_id",
+            "user_id",
+            sqlite_where=text("letter IS NOT NULL"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False, index=True, unique=True)
     name = Column(String(32), nullable=False)
 
     # letter is what this user in this swap wants to receive from another user
@@ -218,9 +443,9 @@ class SwapUser(Base):
     done_watching = Column(Boolean, nullable=False, default=False)
 
     # santa is the user who is gifting to this user (i.e. santa)
-    santa_id = Column(Integer, nullable=True, default=None)
+    santa_id = Column(Integer, nullable=True, default=None, index=True)
     # giftee is the user who this user is gifting to (i.e. giftee)
-    giftee_id = Column(Integer, nullable=True, default=None)
+    giftee_id = Column(Integer, nullable=True, default=None, index=True)
 
     letterboxd_username = Column(String(64), nullable=True, default=None)
 
@@ -236,6 +461,25 @@ class LetterBackup(Base):
     )
 
 
+def _upsert_backup_letters(stmt: Any) -> Any:
+    """
+    turns an insert into letter_backup into an upsert, which only writes rows whose letter changed
+    """
+    return stmt.on_conflict_do_update(
+        index_elements=[LetterBackup.user_id],
+        set_={"letter": stmt.excluded.letter, "updated_at": func.now()},
+        where=LetterBackup.letter.is_distinct_from(stmt.excluded.letter),  # type: ignore[no-untyped-call]
+    )
+
+
+def _set_backup_letter(session: Session, user_id: int, letter: str) -> None:
+    session.execute(
+        _upsert_backup_letters(
+            sqlite_insert(LetterBackup).values(user_id=user_id, letter=letter)
+        )
+    )
+
+
 def set_backup_letter(user_id: int, letter: str) -> None:
     if not isinstance(letter, str):
         logger.warning(
@@ -243,32 +487,26 @@ def set_backup_letter(user_id: int, letter: str) -> None:
         )
         return
     logger.info(f"Adding backup letter for {user_id}")
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # just delete and re-add
-        session.query(LetterBackup).filter_by(user_id=user_id).delete()
-        session.add(LetterBackup(user_id=user_id, letter=letter))
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        _set_backup_letter(session, user_id, letter)
         session.commit()
 
 
 def backup_all_letters() -> None:
     logger.info("Backing up letters...")
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        users = [u for u in session.query(SwapUser) if u.letter is not None]
-        backups = {ltr.user_id: ltr.letter for ltr in session.query(LetterBackup).all()}
-        for u in users:
-            if not u.letter:
-                continue
-            if u.user_id in backups:
-                if u.letter == backups[u.user_id]:
-                    continue
-                logger.info(f"Updating backup letter for {u.user_id}")
-                session.query(LetterBackup).filter_by(user_id=u.user_id).update(
-                    {"letter": u.letter}
-                )
-            else:
-                logger.info(f"Adding backup letter for {u.user_id}")
-                session.add(LetterBackup(user_id=u.user_id, letter=u.letter))
+    letters = (
+        select(SwapUser.user_id, SwapUser.letter)  # type: ignore[arg-type]
+        .where(SwapUser.letter.is_not(None))  # type: ignore[attr-defined]
+        .where(SwapUser.letter != "")
+    )
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        result = session.execute(
+            _upsert_backup_letters(
+                sqlite_insert(LetterBackup).from_select(["user_id", "letter"], letters)
+            )
+        )
         session.commit()
+    logger.info(f"Added/updated {result.rowcount} backup letters")
 
 
 class Banned(Base):
@@ -278,13 +516,13 @@ class Banned(Base):
 
     @staticmethod
     def list_banned() -> list[Banned]:
-        with Session(engine) as session:  # type: ignore[attr-defined]
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
             return session.query(Banned).all()  # type: ignore[no-any-return]
 
 
 def ban_user(user_id: int) -> None:
     logger.info(f"Banning user {user_id}")
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         # check if already banned
         if session.query(Banned).filter_by(user_id=user_id).count() > 0:
             logger.info(f"User {user_id} is already banned")
@@ -294,14 +532,17 @@ def ban_user(user_id: int) -> None:
         session.add(banned)
 
         logger.info(f"Deleting user {user_id} from SwapUser")
+        related = _related_users(session, user_id)
         # delete from SwapUser if present
         session.query(SwapUser).filter_by(user_id=user_id).delete()
 
         session.commit()
+    participants.discard(user_id)
+    embed_cache.bump(*related)
 
 
 def unban_user(user_id: int) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         if session.query(Banned).filter_by(user_id=user_id).count() == 0:
             logger.info(f"User {user_id} is not banned")
             raise RuntimeError("User is not banned")
@@ -309,28 +550,138 @@ def unban_user(user_id: int) -> None:
         logger.info(f"Unbanning user {user_id}")
         session.query(Banned).filter_by(user_id=user_id).delete()
         session.commit()
+    embed_cache.bump(user_id)
 
 
-def check_active_user(user_id: int) -> str | None:
+@dataclass
+class UserContext:
     """
-    returns an error message if the user is banned or not in the swap, otherwise None if active
+    everything a command needs to know about a user, loaded in one query by load_user_context
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        banned = session.query(Banned).filter_by(user_id=user_id).count() > 0
-        if banned:
-            logger.info(f"User {user_id} is banned")
-            return "You are banned from the swap, If you've finished your gift, please post your thoughts in the swap thread and ask a mod to unban you"
 
-        user = session.query(SwapUser).filter_by(user_id=user_id).count() > 0
-        if user:
-            return None
-        else:
-            logger.info(f"User {user_id} is not in the swap")
+    user_id: int
+    banned: bool
+    # this users row, None if they aren't in the swap
+    user: SwapUser | None
+    # the user gifting to this user
+    santa: SwapUser | None
+    # the user this user is gifting to
+    giftee: SwapUser | None
+    # None if no swap has been configured
+    period: SwapPeriod | None
+    # the embed_cache version this was loaded at
+    version: tuple[int, int] = (-1, -1)
+
+    @property
+    def error(self) -> str | None:
+        """
+        returns an error message if the user is banned or not in the swap, otherwise None if active
+        """
+        if self.banned:
+            logger.info(f"User {self.user_id} is banned")
+            return "You are banned from the swap, If you've finished your gift, please post your thoughts in the swap thread and ask a mod to unban you"
+        if self.user is None:
+            logger.info(f"User {self.user_id} is not in the swap")
             return "You are not in the swap, click the 'join button' in the swap channel to join"
+        return None
+
+    @property
+    def has_set_gift(self) -> bool:
+        if self.user is None or self.user.gift is None:
+            return False
+        return self.user.gift.strip() != ""
+
+
+def load_user_context(user_id: int) -> UserContext:
+    """
+    loads whether the user is banned, their SwapUser row and their santa/giftee rows
+    in a single query. the current period comes from the cached swap
+
+    this is cached in embed_cache until the user/their santa/giftee changes
+    """
+    # get the version before reading, so if this is changed while we're
+    # reading, what we read is cached under the old (stale) version
+    version = embed_cache.version(user_id)
+    context: UserContext | None = embed_cache.get(user_id, "context", version)
+    if context is None:
+        context = _load_user_context(user_id)
+        context.version = version
+        embed_cache.put(user_id, "context", version, context)
+    return context
+
+
+def _cached_embed(
+    kind: str,
+    context: UserContext,
+    build: Callable[[UserContext], discord.Embed],
+) -> discord.Embed:
+    """
+    returns the embed cached for this users context, building it if its not cached
+    """
+    if context.version != embed_cache.version(context.user_id):
+        # the context is older than whats in the database, dont cache anything built from it
+        return build(context)
+    embed: discord.Embed | None = embed_cache.get(
+        context.user_id, kind, context.version
+    )
+    if embed is None:
+        embed = build(context)
+        embed_cache.put(context.user_id, kind, context.version, embed)
+    # embeds are mutable, so callers get their own copy
+    return embed.copy()
+
+
+def _related_users(session: Session, user_id: int) -> list[int | None]:
+    """
+    a user, and the users whose embeds show their row (their santa and giftee)
+    """
+    row = (
+        session.query(SwapUser.santa_id, SwapUser.giftee_id)
+        .filter_by(user_id=user_id)
+        .one_or_none()
+    )
+    if row is None:
+        return [user_id]
+    return [user_id, row.santa_id, row.giftee_id]
+
+
+def _load_user_context(user_id: int) -> UserContext:
+    me = aliased(SwapUser)
+    santa = aliased(SwapUser)
+    giftee = aliased(SwapUser)
+    # one row select, so that this returns something even if the user isn't in the swap
+    base = select(literal(user_id).label("user_id")).subquery()  # type: ignore[attr-defined]
+    stmt = (
+        select(
+            exists().where(Banned.user_id == base.c.user_id).label("banned"),  # type: ignore[arg-type]
+            me,  # type: ignore[arg-type]
+            santa,
+            giftee,
+        )
+        .select_from(base)
+        .outerjoin(me, me.user_id == base.c.user_id)  # type: ignore[arg-type]
+        .outerjoin(santa, santa.giftee_id == base.c.user_id)  # type: ignore[arg-type]
+        .outerjoin(giftee, giftee.santa_id == base.c.user_id)  # type: ignore[arg-type]
+    )
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        row = session.execute(stmt).one()
+    period: SwapPeriod | None
+    try:
+        period = Swap.get_swap_period()
+    except RuntimeError:
+        period = None
+    return UserContext(
+        user_id=user_id,
+        banned=bool(row[0]),
+        period=period,
+        user=row[1],
+        santa=row[2],
+        giftee=row[3],
+    )
 
 
 def set_gift_done(user_id: int) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         user = session.query(SwapUser).filter_by(user_id=user_id).one_or_none()
         if user is None:
             logger.info(f"User {user_id} is not in the swap")
@@ -344,17 +695,13 @@ def set_gift_done(user_id: int) -> None:
 
         user.done_watching = True
         session.add(user)
+        related = _related_users(session, user_id)
         session.commit()
-
-
-def user_has_letter(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        return user.letter is not None
+    embed_cache.bump(*related)
 
 
 def join_swap(user_id: int, name: str) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         is_banned = session.query(Banned).filter_by(user_id=user_id).count() > 0
 
         if is_banned:
@@ -386,10 +733,12 @@ def join_swap(user_id: int, name: str) -> None:
             swap_user = SwapUser(user_id=user_id, name=name)
         session.add(swap_user)
         session.commit()
+    participants.add(user_id)
+    embed_cache.bump(user_id)
 
 
 def restore_letter(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         user = session.query(SwapUser).filter_by(user_id=user_id).one()
         if user.letter is not None:
             logger.info(
@@ -406,12 +755,14 @@ def restore_letter(user_id: int) -> bool:
         session.query(SwapUser).filter_by(user_id=user_id).update(
             values={"letter": backup.letter}
         )
+        related = _related_users(session, user_id)
         session.commit()
-        return True
+    embed_cache.bump(*related)
+    return True
 
 
 def leave_swap(user_id: int) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one_or_none()
         if swap_user is None:
             logger.info(f"User {user_id} tried to leave swap but was not in swap")
@@ -419,72 +770,64 @@ def leave_swap(user_id: int) -> None:
                 "You are already not in the swap. To rejoin, click the 'join button' in the swap channel"
             )
         logger.info(f"Deleting {user_id} from the database")
+        related = _related_users(session, user_id)
         session.delete(swap_user)
         session.commit()
+    participants.discard(user_id)
+    embed_cache.bump(*related)
 
 
 def set_letter(user_id: int, letter: str) -> None:
     """
     This is how a user sets their letter, to tell their santa what they want
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        assert len(letter) <= 4000, "Letter too long, must be less than 4000 characters"
+    assert len(letter) <= 4000, "Letter too long, must be less than 4000 characters"
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        updated = (
+            session.query(SwapUser)
+            .filter_by(user_id=user_id)
+            .update({"letter": letter})
+        )
+        if updated == 0:
+            raise RuntimeError("User is not in the swap")
         logger.info(f"User {user_id} set their letter to {letter}")
-        swap_user.letter = letter
-        session.add(swap_user)
+        related = _related_users(session, user_id)
+        # in the same transaction, so this is one commit
+        _set_backup_letter(session, user_id, letter)
         session.commit()
-    set_backup_letter(user_id, letter)
-
-
-def has_giftee(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        return swap_user.giftee_id is not None
-
-
-def has_santa(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        return swap_user.santa_id is not None
+    embed_cache.bump(*related)
 
 
 def get_santa(user_id: int) -> SwapUser | None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         return session.query(SwapUser).filter_by(giftee_id=user_id).one_or_none()  # type: ignore[no-any-return]
 
 
 def get_giftee(user_id: int) -> SwapUser | None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         # yes, this is how these work -- to get users giftee, we get the user who has this user as their santa
         return session.query(SwapUser).filter_by(santa_id=user_id).one_or_none()  # type: ignore[no-any-return]
 
 
-def has_set_gift(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        if swap_user.gift is None:
-            return False
-        if swap_user.gift.strip() == "":
-            return False
-        return True
-
-
 def set_gift(user_id: int, gift: str) -> None:
     """
     This is how a user sets their gift, to tell their giftee what they're giving them
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        assert len(gift) <= 4000, "Gift too long, must be less than 4000 characters"
-        logger.info(f"User {user_id} set their gift for {swap_user.giftee_id}: {gift}")
-        swap_user.gift = gift
-        session.add(swap_user)
+    assert len(gift) <= 4000, "Gift too long, must be less than 4000 characters"
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        updated = (
+            session.query(SwapUser).filter_by(user_id=user_id).update({"gift": gift})
+        )
+        if updated == 0:
+            raise RuntimeError("User is not in the swap")
+        logger.info(f"User {user_id} set their gift: {gift}")
+        related = _related_users(session, user_id)
         session.commit()
+    embed_cache.bump(*related)
 
 
 def set_letterboxd(user_id: int, letterboxd: str) -> None:
-    with Session(engine) as session:  # type: ignore[attr-defined]
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
         assert (
             len(letterboxd) <= 64
@@ -493,243 +836,1042 @@ def set_letterboxd(user_id: int, letterboxd: str) -> None:
         swap_user.letterboxd_username = letterboxd
         session.add(swap_user)
         session.commit()
+    embed_cache.bump(user_id)
 
 
-def has_letter(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        return swap_user.letter is not None
-
-
-def has_gift(user_id: int) -> bool:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swap_user = session.query(SwapUser).filter_by(user_id=user_id).one()
-        return swap_user.gift is not None
-
-
-def review_my_letter_embed(user_id: int) -> discord.Embed:
+def review_my_letter_embed(
+    user_id: int, context: UserContext | None = None
+) -> discord.Embed:
     """
     Read your own letter, to review
     """
+    if context is None:
+        context = load_user_context(user_id)
+    return _cached_embed("review-letter", context, _review_my_letter_embed)
 
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swapuser = session.query(SwapUser).filter_by(user_id=user_id).one()
-        if swapuser.letter is None:
-            logger.info(
-                f"User {user_id} tried to review their letter, but they haven't set it yet"
-            )
-            return discord.Embed(
-                title="You haven't set your letter yet!",
-                description="Use the `>letter` command to send your letter",
-            )
+
+def _review_my_letter_embed(context: UserContext) -> discord.Embed:
+    user_id = context.user_id
+    swapuser = context.user
+    if swapuser is None or swapuser.letter is None:
+        logger.info(
+            f"User {user_id} tried to review their letter, but they haven't set it yet"
+        )
+        return discord.Embed(
+            title="You haven't set your letter yet!",
+            description="Use the `>letter` command to send your letter",
+        )
 
     let = f"""Dear Santa,\n\n{swapuser.letter}\n\nLove, {swapuser.name}"""
     embed = discord.Embed(title="You received a letter!", description=let)
     return embed
 
 
-def review_my_gift_embed(user_id: int) -> discord.Embed:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # read your own gift (what you sent as a recommendation), to review
-        swapuser = session.query(SwapUser).filter_by(user_id=user_id).one()
-        if swapuser.gift is None:
-            logger.info(
-                f"User {user_id} tried to review their gift, but they haven't set it yet"
-            )
-            return discord.Embed(
-                title="You haven't set your gift yet!",
-                description="Use the `>submit` command to set your gift",
-            )
+def review_my_gift_embed(
+    user_id: int, context: UserContext | None = None
+) -> discord.Embed:
+    # read your own gift (what you sent as a recommendation), to review
+    if context is None:
+        context = load_user_context(user_id)
+    return _cached_embed("review-gift", context, _review_my_gift_embed)
 
-        # find the user who has this user as their santa
-        given_to = session.query(SwapUser).filter_by(santa_id=user_id).one_or_none()
 
-        if given_to is None:
-            logger.info(
-                f"User {user_id} tried to review their gift, but they haven't been assigned a giftee yet"
-            )
-            return discord.Embed(
-                title="You haven't been assigned a giftee yet!",
-                description="You'll have to wait for the swap to start",
-            )
+def _review_my_gift_embed(context: UserContext) -> discord.Embed:
+    user_id = context.user_id
+    swapuser = context.user
+    if swapuser is None or swapuser.gift is None:
+        logger.info(
+            f"User {user_id} tried to review their gift, but they haven't set it yet"
+        )
+        return discord.Embed(
+            title="You haven't set your gift yet!",
+            description="Use the `>submit` command to set your gift",
+        )
+
+    # the user who has this user as their santa
+    given_to = context.giftee
 
-        gift = f"""Dear {given_to.name},\n\n{swapuser.gift}\n\nLove, Santa"""
-        embed = discord.Embed(title="You received a gift!", description=gift)
-        return embed
+    if given_to is None:
+        logger.info(
+            f"User {user_id} tried to review their gift, but they haven't been assigned a giftee yet"
+        )
+        return discord.Embed(
+            title="You haven't been assigned a giftee yet!",
+            description="You'll have to wait for the swap to start",
+        )
+
+    gift = f"""Dear {given_to.name},\n\n{swapuser.gift}\n\nLove, Santa"""
+    embed = discord.Embed(title="You received a gift!", description=gift)
+    return embed
 
 
-def receive_gift_embed(user_id: int, raise_if_missing: bool = False) -> discord.Embed:
+def receive_gift_embed(
+    user_id: int, raise_if_missing: bool = False, context: UserContext | None = None
+) -> discord.Embed:
     """
     This is how a user receives their gift, to see what their santa recommended them
     """
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # to receive gift, find the user whose giftee is this user
-        santa_user = session.query(SwapUser).filter_by(giftee_id=user_id).one_or_none()
-        if santa_user is None:
+    if context is None:
+        context = load_user_context(user_id)
+    # these raise instead of returning some embeds, so are cached separately
+    return _cached_embed(
+        f"receive-{raise_if_missing}",
+        context,
+        functools.partial(_receive_gift_embed, raise_if_missing=raise_if_missing),
+    )
+
+
+def _receive_gift_embed(
+    context: UserContext, raise_if_missing: bool = False
+) -> discord.Embed:
+    user_id = context.user_id
+    # to receive gift, find the user whose giftee is this user
+    santa_user = context.santa
+    if santa_user is None:
+        logger.info(
+            f"User {user_id} tried to receive their gift, but they haven't been assigned a santa yet"
+        )
+        if raise_if_missing:
+            raise RuntimeError(
+                "User tried to receive their gift, but they haven't been assigned a santa yet"
+            )
+        return discord.Embed(
+            title="You don't have a santa yet!",
+            description="If you joined late, you may get assigned one soon, or you'll have to wait for the next swap to start",
+        )
+
+    match context.period:
+        case SwapPeriod.JOIN:
             logger.info(
-                f"User {user_id} tried to receive their gift, but they haven't been assigned a santa yet"
+                f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in JOIN period)"
             )
-            if raise_if_missing:
-                raise RuntimeError(
-                    "User tried to receive their gift, but they haven't been assigned a santa yet"
-                )
             return discord.Embed(
-                title="You don't have a santa yet!",
-                description="If you joined late, you may get assigned one soon, or you'll have to wait for the next swap to start",
+                title="The swap hasn't started yet!",
+                description="Once the 'swap' period has started, you can check again for your gift. If you haven't set your >letter yet, do so now!",
             )
-
-        match Swap.get_swap_period():
-            case SwapPeriod.JOIN:
-                logger.info(
-                    f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in JOIN period)"
-                )
-                return discord.Embed(
-                    title="The swap hasn't started yet!",
-                    description="Once the 'swap' period has started, you can check again for your gift. If you haven't set your >letter yet, do so now!",
-                )
-            case SwapPeriod.SWAP:
-                logger.info(
-                    f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in SWAP period)"
-                )
-                return discord.Embed(
-                    title="The swap hasn't started yet!",
-                    description="Once the 'watch' period starts, you can re-run this command to see your gift",
-                )
-            case _:
-                pass
-
-        if santa_user.gift is None:
+        case SwapPeriod.SWAP:
             logger.info(
-                f"User {user_id} tried to receive their gift, but their santa {santa_user.user_id} {santa_user.name} hasn't set it yet"
+                f"User {user_id} tried to receive their gift, but the swap hasn't started yet (currently in SWAP period)"
             )
-            if raise_if_missing:
-                raise RuntimeError(
-                    "User tried to receive their gift, but their santa hasn't set it yet"
-                )
             return discord.Embed(
-                title="You haven't received a gift yet!",
-                description="Please wait for your santa to send their gift. If the 'watch' period has already started, you can ask the mods to make sure your santa sent their gift",
+                title="The swap hasn't started yet!",
+                description="Once the 'watch' period starts, you can re-run this command to see your gift",
             )
+        case _:
+            pass
 
-        my_swapuser = session.query(SwapUser).filter_by(user_id=user_id).one()
+    if santa_user.gift is None:
+        logger.info(
+            f"User {user_id} tried to receive their gift, but their santa {santa_user.user_id} {santa_user.name} hasn't set it yet"
+        )
+        if raise_if_missing:
+            raise RuntimeError(
+                "User tried to receive their gift, but their santa hasn't set it yet"
+            )
+        return discord.Embed(
+            title="You haven't received a gift yet!",
+            description="Please wait for your santa to send their gift. If the 'watch' period has already started, you can ask the mods to make sure your santa sent their gift",
+        )
 
-        gift = f"""Dear {my_swapuser.name},\n\n{santa_user.gift}\n\nLove, Santa"""
+    my_swapuser = context.user
+    if my_swapuser is None:
+        raise RuntimeError("User is not in the swap")
 
-        embed = discord.Embed(title="You received a gift!", description=gift)
-        return embed
+    gift = f"""Dear {my_swapuser.name},\n\n{santa_user.gift}\n\nLove, Santa"""
 
+    embed = discord.Embed(title="You received a gift!", description=gift)
+    return embed
 
-def read_giftee_letter(user_id: int) -> discord.Embed:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        # read your giftee's letter, this is how you find out what they want
-        #
-        # 'their santa_id is my user id', so we read their letter
-        giftee_user = session.query(SwapUser).filter_by(santa_id=user_id).one_or_none()
-        if giftee_user is None:
+
+def read_giftee_letter(
+    user_id: int, context: UserContext | None = None
+) -> discord.Embed:
+    # read your giftee's letter, this is how you find out what they want
+    #
+    # 'their santa_id is my user id', so we read their letter
+    if context is None:
+        context = load_user_context(user_id)
+    return _cached_embed("read-letter", context, _read_giftee_letter)
+
+
+def _read_giftee_letter(context: UserContext) -> discord.Embed:
+    user_id = context.user_id
+    giftee_user = context.giftee
+    if giftee_user is None:
+        logger.info(
+            f"User {user_id} tried to read their giftee's letter, but they haven't been assigned a giftee yet"
+        )
+        return discord.Embed(
+            title="You haven't been assigned a giftee yet!",
+            description="You'll have to wait for the swap to start. If you think this is a mistake, ask a mod to check",
+        )
+
+    if giftee_user.letter is None:
+        logger.info(
+            f"User {user_id} tried to read their giftee's letter, but their giftee {giftee_user.user_id} {giftee_user.name} hasn't set it yet"
+        )
+        return discord.Embed(
+            title="Your giftee hasn't set their letter yet!",
+            description="Wait for your giftee to set their letter",
+        )
+
+    if context.period is None:
+        raise RuntimeError("No swap configured")
+
+    match context.period:
+        case SwapPeriod.JOIN:
             logger.info(
-                f"User {user_id} tried to read their giftee's letter, but they haven't been assigned a giftee yet"
+                f"User {user_id} tried to read their giftee's letter, but the swap hasn't started yet (currently in JOIN period)"
             )
             return discord.Embed(
-                title="You haven't been assigned a giftee yet!",
-                description="You'll have to wait for the swap to start. If you think this is a mistake, ask a mod to check",
+                title="The swap hasn't started yet!",
+                description="Once the 'swap' period has started, you can check again for your giftee's letter",
             )
+        case _:
+            pass
 
-        if giftee_user.letter is None:
-            logger.info(
-                f"User {user_id} tried to read their giftee's letter, but their giftee {giftee_user.user_id} {giftee_user.name} hasn't set it yet"
+    let = f"""Dear Santa,\n\n{giftee_user.letter}\n\nLove, {giftee_user.name}"""
+    embed = discord.Embed(title="Your giftee sent a letter!", description=let)
+    return embed
+
+
+def _period_messages(
+    session: Session, period: SwapPeriod
+) -> list[tuple[int, discord.Embed]]:
+    """
+    the DMs sent to each user when the period is set, their giftees letter
+    when the swap starts and their gift when the watch period starts
+
+    everyone's santa/giftee rows are loaded in one query, and the embeds are built
+    directly from those (not through embed_cache, which would fill up with one-off embeds)
+    """
+    me = aliased(SwapUser)
+    santa = aliased(SwapUser)
+    giftee = aliased(SwapUser)
+    stmt = (
+        select(me, santa, giftee)  # type: ignore[arg-type]
+        .join(giftee, giftee.santa_id == me.user_id)  # type: ignore[arg-type]
+        .outerjoin(santa, santa.giftee_id == me.user_id)  # type: ignore[arg-type]
+    )
+    messages: list[tuple[int, discord.Embed]] = []
+    for user, santa_user, giftee_user in session.execute(stmt):
+        context = UserContext(
+            user_id=user.user_id,
+            banned=False,
+            user=user,
+            santa=santa_user,
+            giftee=giftee_user,
+            period=period,
+        )
+        if period == SwapPeriod.SWAP:
+            messages.append((user.user_id, _read_giftee_letter(context)))
+        elif period == SwapPeriod.WATCH:
+            try:
+                messages.append(
+                    (user.user_id, _receive_gift_embed(context, raise_if_missing=True))
+                )
+            except RuntimeError as e:
+                logger.info(f"Not sending gift to {user.user_id} {user.name}: {e}")
+    return messages
+
+
+class OutboxStatus(enum.Enum):
+    PENDING = "pending"
+    # claimed by the delivery worker, if the bot restarts while a message is in this
+    # state we can't know if it was delivered, so its marked failed instead of resent
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class OutboxMessage(Base):
+    """
+    DMs the bot sends on its own (not replies to a command), these are
+    delivered by the OutboxWorker in the background
+    """
+
+    __tablename__ = "outbox"
+    __table_args__ = (
+        Index("ix_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # a name for the group of messages this was sent as part of, e.g. 'period-swap-1697650000'
+    batch = Column(String(64), nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
+    content = Column(Text, nullable=True, default=None)
+    # json from discord.Embed.to_dict
+    embed = Column(Text, nullable=True, default=None)
+    # hash of the recipient/payload, so the same message isn't queued twice
+    payload_hash = Column(String(64), nullable=False)
+
+    status = Column(Enum(OutboxStatus), nullable=False, default=OutboxStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True, default=None)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True, default=None)
+
+
+@dataclass
+class OutboxItem:
+    id: int
+    user_id: int
+    content: str | None
+    embed: discord.Embed | None
+    attempts: int
+
+
+def _payload_hash(user_id: int, content: str | None, embed: str | None) -> str:
+    return hashlib.sha256(
+        json.dumps([user_id, content, embed]).encode("utf-8")
+    ).hexdigest()
+
+
+def _enqueue_messages(
+    session: Session,
+    batch: str,
+    messages: Iterable[tuple[int, str | None, discord.Embed | None]],
+) -> int:
+    """
+    add messages to the outbox in the callers transaction, skipping any which
+    are already waiting to be sent. returns how many were queued
+    """
+    waiting = {
+        h
+        for (h,) in session.query(OutboxMessage.payload_hash).filter(
+            OutboxMessage.status.in_([OutboxStatus.PENDING, OutboxStatus.SENDING])
+        )
+    }
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    rows = []
+    for user_id, content, embed in messages:
+        embed_json = json.dumps(embed.to_dict()) if embed is not None else None
+        payload_hash = _payload_hash(user_id, content, embed_json)
+        if payload_hash in waiting:
+            logger.info(f"Message to {user_id} is already in the outbox, skipping")
+            continue
+        waiting.add(payload_hash)
+        rows.append(
+            {
+                "batch": batch,
+                "user_id": user_id,
+                "content": content,
+                "embed": embed_json,
+                "payload_hash": payload_hash,
+                "status": OutboxStatus.PENDING,
+                "attempts": 0,
+                "next_attempt_at": now,
+            }
+        )
+    if rows:
+        session.execute(insert(OutboxMessage), rows)  # type: ignore[arg-type]
+    logger.info(f"Queued {len(rows)} messages in outbox batch {batch}")
+    return len(rows)
+
+
+def recover_outbox() -> int:
+    """
+    run once on startup, before the delivery worker starts. anything that was
+    being sent when the bot stopped may or may not have been delivered, so to
+    never send a message twice, those are marked as failed
+    """
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        count: int = (
+            session.query(OutboxMessage)
+            .filter_by(status=OutboxStatus.SENDING)
+            .update(
+                {
+                    "status": OutboxStatus.FAILED,
+                    "last_error": "Bot stopped while sending, may have been delivered",
+                },
+                synchronize_session=False,
             )
-            return discord.Embed(
-                title="Your giftee hasn't set their letter yet!",
-                description="Wait for your giftee to set their letter",
+        )
+        session.commit()
+    if count:
+        logger.warning(f"Marked {count} interrupted outbox messages as failed")
+    return count
+
+
+def claim_outbox(limit: int) -> list[OutboxItem]:
+    """
+    mark up to limit messages that are due as SENDING, and return them
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        rows = (
+            session.query(
+                OutboxMessage.id,
+                OutboxMessage.user_id,
+                OutboxMessage.content,
+                OutboxMessage.embed,
+                OutboxMessage.attempts,
             )
+            .filter(OutboxMessage.status == OutboxStatus.PENDING)
+            .filter(OutboxMessage.next_attempt_at <= now)
+            .order_by(OutboxMessage.id)
+            .limit(limit)
+            .all()
+        )
+        if not rows:
+            return []
+        session.query(OutboxMessage).filter(
+            OutboxMessage.id.in_([r.id for r in rows])
+        ).update(
+            {
+                "status": OutboxStatus.SENDING,
+                "attempts": OutboxMessage.attempts + 1,
+            },
+            synchronize_session=False,
+        )
+        session.commit()
+    return [
+        OutboxItem(
+            id=r.id,
+            user_id=r.user_id,
+            content=r.content,
+            embed=(
+                discord.Embed.from_dict(json.loads(r.embed))
+                if r.embed is not None
+                else None
+            ),
+            attempts=r.attempts + 1,
+        )
+        for r in rows
+    ]
+
+
+def mark_outbox_sent(message_id: int) -> None:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        session.query(OutboxMessage).filter_by(id=message_id).update(
+            {
+                "status": OutboxStatus.SENT,
+                "sent_at": datetime.datetime.now(tz=datetime.timezone.utc),
+                "last_error": None,
+            },
+            synchronize_session=False,
+        )
+        session.commit()
 
-        swap = Swap.get_swap()
 
-        assert isinstance(swap.period, SwapPeriod)
-        match swap.period:
-            case SwapPeriod.JOIN:
-                logger.info(
-                    f"User {user_id} tried to read their giftee's letter, but the swap hasn't started yet (currently in JOIN period)"
+def mark_outbox_failed(message_id: int, error: str, retry_in: float | None) -> None:
+    """
+    if retry_in (seconds) is None, the message is not retried
+    """
+    values: dict[str, Any] = {"last_error": error[:1000]}
+    if retry_in is None:
+        values["status"] = OutboxStatus.FAILED
+    else:
+        values["status"] = OutboxStatus.PENDING
+        values["next_attempt_at"] = datetime.datetime.now(
+            tz=datetime.timezone.utc
+        ) + datetime.timedelta(seconds=retry_in)
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        session.query(OutboxMessage).filter_by(id=message_id).update(
+            values, synchronize_session=False
+        )
+        session.commit()
+
+
+def outbox_batch_status(batch: str) -> dict[OutboxStatus, int]:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        counts = {status: 0 for status in OutboxStatus}
+        for status, count in (
+            session.query(OutboxMessage.status, func.count())
+            .filter(OutboxMessage.batch == batch)
+            .group_by(OutboxMessage.status)
+        ):
+            counts[status] = count
+        return counts
+
+
+def outbox_failed_recipients(batch: str) -> list[int]:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        return [
+            user_id
+            for (user_id,) in session.query(OutboxMessage.user_id).filter_by(
+                batch=batch, status=OutboxStatus.FAILED
+            )
+        ]
+
+
+# tables whose changes are recorded in the change log, and their primary key
+CHANGE_LOG_TABLES = {
+    "swaps": "id",
+    "swap_users": "id",
+    "banned": "user_id",
+    "letter_backup": "user_id",
+}
+
+
+class ChangeLog(Base):
+    """
+    which rows have changed since the last snapshot, filled in by sqlite triggers
+    (see _change_log_triggers), so every write is recorded, not just ones made
+    through the ORM. rows are removed once they're included in a snapshot
+    """
+
+    __tablename__ = "change_log"
+    # so ids keep increasing after old rows are removed
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(32), nullable=False)
+    row_id = Column(Integer, nullable=False)
+
+
+def _change_log_triggers() -> list[str]:
+    triggers = []
+    for table, key in CHANGE_LOG_TABLES.items():
+        log_new = f"INSERT INTO change_log (table_name, row_id) VALUES ('{table}', NEW.{key});"
+        log_old = f"INSERT INTO change_log (table_name, row_id) VALUES ('{table}', OLD.{key});"
+        # if the key itself changed, the old row is gone too
+        log_old_if_moved = f"INSERT INTO change_log (table_name, row_id) SELECT '{table}', OLD.{key} WHERE OLD.{key} IS NOT NEW.{key};"
+        triggers.extend(
+            [
+                f"CREATE TRIGGER IF NOT EXISTS change_log_{table}_insert AFTER INSERT ON {table} BEGIN {log_new} END",
+                f"CREATE TRIGGER IF NOT EXISTS change_log_{table}_update AFTER UPDATE ON {table} BEGIN {log_new} {log_old_if_moved} END",
+                f"CREATE TRIGGER IF NOT EXISTS change_log_{table}_delete AFTER DELETE ON {table} BEGIN {log_old} END",
+            ]
+        )
+    return triggers
+
+
+class SnapshotKind(enum.Enum):
+    FULL = "full"
+    DELTA = "delta"
+    # the JSON export of a full snapshot (its base), removed along with it
+    EXPORT = "export"
+
+
+class Snapshot(Base):
+    """
+    catalog of the snapshots in BACKUP_DIR. a full snapshot is a copy of the database,
+    a delta has the rows which changed since the previous snapshot, and an export
+    is the swap exported from a full snapshot (see export_snapshot)
+    """
+
+    __tablename__ = "snapshots"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(Enum(SnapshotKind), nullable=False)
+    path = Column(String(256), nullable=False)
+    # for deltas, the full snapshot this (and the deltas before it) apply on top of,
+    # for exports, the full snapshot it was exported from
+    base_id = Column(Integer, nullable=True, default=None)
+    # the last change_log id included in this snapshot
+    change_seq = Column(Integer, nullable=False)
+    # size of the file in bytes
+    size = Column(Integer, nullable=False, default=0)
+    # JSON, rows per table (every row for full snapshots, changed rows for deltas)
+    row_counts = Column(Text, nullable=False, default="{}")
+    created_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+
+
+def latest_snapshot(kind: SnapshotKind | None = None) -> Snapshot | None:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        return _latest_snapshot(session, kind)
+
+
+def _latest_snapshot(session: Session, kind: SnapshotKind | None) -> Snapshot | None:
+    query = session.query(Snapshot)
+    if kind is not None:
+        query = query.filter_by(kind=kind)
+    else:
+        # exports aren't part of the chain of snapshots
+        query = query.filter(Snapshot.kind != SnapshotKind.EXPORT)
+    return query.order_by(Snapshot.id.desc()).first()  # type: ignore[no-any-return]
+
+
+def snapshot_database(name: str | None = None) -> str:
+    """
+    copy the database to BACKUP_DIR, returning the path to the copy
+    """
+    from sqlite_backup.core import sqlite_backup
+
+    logger.info("Making backup of database...")
+
+    path = os.path.join(settings.BACKUP_DIR, name or f"{int(time.time())}.sqlite")
+    sqlite_backup(settings.SQLITEDB_PATH, path)
+    return path
+
+
+SNAPSHOT_BATCH_SIZE = 1000
+
+
+def export_snapshot(sqlite_path: str) -> str:
+    """
+    export the swapuser data from a database backup (see snapshot_database) to a
+    gzipped JSON lines file next to it, returning the path to the export
+
+    the first line is a header with the export time and banned user ids, then
+    one line per swapuser. rows are streamed from the backup and written as
+    they're read, so this doesn't hold the whole swap in memory. since this
+    reads from the backup instead of the live database, it doesn't block writes
+    """
+    export_path = os.path.splitext(sqlite_path)[0] + ".jsonl.gz"
+    tmp_path = export_path + ".tmp"
+
+    engine = create_engine(f"sqlite:///file:{sqlite_path}?mode=ro&uri=true")
+    santa = aliased(SwapUser)
+    giftee = aliased(SwapUser)
+    exported = 0
+    try:
+        with Session(engine) as session:  # type: ignore[attr-defined]
+            with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+
+                def _write(record: dict[str, Any]) -> None:
+                    f.write(json.dumps(record, separators=(",", ":")))
+                    f.write("\n")
+
+                _write(
+                    {
+                        "exported_at": int(time.time()),
+                        "banned": [u for (u,) in session.query(Banned.user_id)],
+                    }
                 )
-                return discord.Embed(
-                    title="The swap hasn't started yet!",
-                    description="Once the 'swap' period has started, you can check again for your giftee's letter",
+
+                # users who havent been assigned a santa or giftee yet are skipped
+                query = (
+                    session.query(
+                        SwapUser.id,
+                        SwapUser.user_id,
+                        SwapUser.name,
+                        SwapUser.santa_id,
+                        SwapUser.giftee_id,
+                        santa.name,
+                        giftee.name,
+                        SwapUser.letter,
+                        SwapUser.gift,
+                        SwapUser.letterboxd_username,
+                        santa.gift,
+                        SwapUser.done_watching,
+                    )
+                    .join(santa, santa.user_id == SwapUser.santa_id)
+                    .join(giftee, giftee.user_id == SwapUser.giftee_id)
+                    .filter(SwapUser.letter.is_not(None))  # type: ignore[attr-defined]
+                    .order_by(SwapUser.id)
+                    .yield_per(SNAPSHOT_BATCH_SIZE)
                 )
-            case _:
-                pass
+                for row in query:
+                    _write(
+                        {
+                            "id": row[0],  # internal id
+                            "user_id": row[1],  # discord user id
+                            "name": row[2],
+                            "santa_id": row[3],
+                            "giftee_id": row[4],
+                            "santa_name": row[5],
+                            "giftee_name": row[6],
+                            "letter": row[7],
+                            "gave_gift": row[8],
+                            "letterboxd": row[9],
+                            "received_gift": row[10],
+                            "done": row[11],
+                        }
+                    )
+                    exported += 1
+        # rename once complete, so a partial export is never picked up
+        os.replace(tmp_path, export_path)
+    finally:
+        engine.dispose()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-        let = f"""Dear Santa,\n\n{giftee_user.letter}\n\nLove, {giftee_user.name}"""
-        embed = discord.Embed(title="Your giftee sent a letter!", description=let)
-        return embed
+    logger.info(f"Exported {exported} swapusers to {export_path}")
+    return export_path
 
 
-def snapshot_database() -> None:
-    logger.info("Making backup of database...")
+def record_export(sqlite_path: str, export_path: str) -> None:
+    """
+    add an export of a full snapshot to the catalog, so its pruned along with it
+    """
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        base = session.query(Snapshot).filter_by(path=sqlite_path).first()
+        if base is None:
+            logger.warning(f"{sqlite_path} isn't in the snapshots catalog")
+            return
+        export = Snapshot(  # type: ignore[misc]
+            kind=SnapshotKind.EXPORT,
+            path=export_path,
+            base_id=base.id,
+            change_seq=base.change_seq,
+            size=os.path.getsize(export_path),
+        )
+        session.add(export)
+        session.commit()
 
-    sqlite_backup(
-        settings.SQLITEDB_PATH,
-        os.path.join(settings.BACKUP_DIR, f"{int(time.time())}.sqlite"),
-    )
 
-    # make JSON export of swapuser data
-
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        swapusers = session.query(SwapUser).all()
-
-        user_map = {}
-        for swapuser in swapusers:
-            user_map[swapuser.user_id] = swapuser
-
-        swapusers_json: dict[str, Any] = {
-            "exported_at": int(time.time()),
-            "banned": [u.user_id for u in session.query(Banned).all()],
-        }
-        swapuser_lst = []
-        for swapuser in swapusers:
-            if (
-                swapuser.santa_id is None
-                or swapuser.giftee_id is None
-                or swapuser.letter is None
-            ):
-                logger.info(
-                    f"User {swapuser.user_id} {swapuser.name} has not been assigned a santa or giftee yet, skipping"
+def _export_snapshot_logged(sqlite_path: str) -> None:
+    try:
+        export_path = export_snapshot(sqlite_path)
+        # this runs on the reader pool, the catalog is written on the writer thread
+        _writer_executor.submit(record_export, sqlite_path, export_path).result()
+    except Exception as e:
+        logger.exception(f"Error exporting snapshot {sqlite_path}: {e}", exc_info=True)
+
+
+def read_snapshot_header(path: str) -> dict[str, Any]:
+    """
+    read the header (exported_at, banned) from a snapshot export
+    """
+    if path.endswith(".json"):
+        # old, uncompressed exports
+        with open(path) as f:
+            data = json.load(f)
+        return {"exported_at": data["exported_at"], "banned": data["banned"]}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())  # type: ignore[no-any-return]
+
+
+def iter_snapshot_records(path: str) -> Iterator[dict[str, Any]]:
+    """
+    lazily iterate over the swapuser records in a snapshot export
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            yield from json.load(f)["swapusers"]
+        return
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        f.readline()  # header
+        for line in f:
+            yield json.loads(line)
+
+
+def _current_change_seq(session: Session) -> int:
+    seq = session.execute(
+        text("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+    ).scalar()
+    return int(seq or 0)
+
+
+def _write_delta(
+    session: Session, path: str, header: dict[str, Any], since_seq: int
+) -> dict[str, int]:
+    """
+    write the current value of every row which changed after since_seq (or None,
+    if it was deleted) to a gzipped JSON lines file, returning how many rows were
+    written for each table
+    """
+    written = {table: 0 for table in CHANGE_LOG_TABLES}
+    tmp_path = path + ".tmp"
+    conn = session.connection()
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(json.dumps(header, separators=(",", ":")) + "\n")
+            for table, key in CHANGE_LOG_TABLES.items():
+                row_ids = [
+                    row_id
+                    for (row_id,) in session.query(ChangeLog.row_id)
+                    .filter(ChangeLog.table_name == table, ChangeLog.id > since_seq)
+                    .group_by(ChangeLog.row_id)
+                ]
+                for i in range(0, len(row_ids), SNAPSHOT_BATCH_SIZE):
+                    chunk = row_ids[i : i + SNAPSHOT_BATCH_SIZE]
+                    # raw sqlite values, so restoring writes back exactly whats stored
+                    result = conn.exec_driver_sql(
+                        f"SELECT * FROM {table} WHERE {key} IN ({','.join('?' * len(chunk))})",
+                        tuple(chunk),
+                    )
+                    columns = list(result.keys())
+                    rows = {
+                        r[columns.index(key)]: dict(zip(columns, r)) for r in result
+                    }
+                    for row_id in chunk:
+                        record = {
+                            "table": table,
+                            "row_id": row_id,
+                            "row": rows.get(row_id),
+                        }
+                        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                        written[table] += 1
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return written
+
+
+def take_snapshot(full: bool = False) -> str | None:
+    """
+    snapshot the database, returning the path to the file written, or None if
+    nothing changed since the last snapshot
+
+    this writes a delta (rows changed since the last snapshot) unless full is set,
+    there's no full snapshot yet, or SNAPSHOT_FULL_EVERY deltas have been written
+    since the last full one. has to run on the writer thread, so no writes happen
+    between reading the change log and recording the snapshot
+
+    old snapshots are pruned afterwards, see prune_snapshots
+    """
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        seq = _current_change_seq(session)
+        last = _latest_snapshot(session, None)
+        base = _latest_snapshot(session, SnapshotKind.FULL)
+        deltas = (
+            session.query(Snapshot)
+            .filter(Snapshot.id > base.id, Snapshot.kind == SnapshotKind.DELTA)
+            .count()
+            if base is not None
+            else 0
+        )
+
+        if (
+            full
+            or last is None
+            or base is None
+            or deltas >= settings.SNAPSHOT_FULL_EVERY
+        ):
+            path = snapshot_database(f"{int(time.time())}-{seq}.sqlite")
+            row_counts = {
+                table: int(
+                    session.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
                 )
+                for table in CHANGE_LOG_TABLES
+            }
+            snapshot = Snapshot(kind=SnapshotKind.FULL, path=path, change_seq=seq)  # type: ignore[misc]
+        elif seq == last.change_seq:
+            logger.info("Nothing changed since the last snapshot, skipping")
+            return None
+        else:
+            path = os.path.join(
+                settings.BACKUP_DIR, f"{int(time.time())}-{seq}.delta.jsonl.gz"
+            )
+            header = {
+                "created_at": int(time.time()),
+                "base": os.path.basename(base.path),
+                "base_seq": base.change_seq,
+                "from_seq": last.change_seq,
+                "to_seq": seq,
+            }
+            row_counts = _write_delta(session, path, header, int(last.change_seq))
+            logger.info(f"Wrote changed rows {row_counts} to {path}")
+            snapshot = Snapshot(  # type: ignore[misc]
+                kind=SnapshotKind.DELTA, path=path, base_id=base.id, change_seq=seq
+            )
+
+        snapshot.size = os.path.getsize(path)  # type: ignore[assignment]
+        snapshot.row_counts = json.dumps(row_counts)  # type: ignore[assignment]
+        session.add(snapshot)
+        # everything up to seq is in this snapshot now
+        session.query(ChangeLog).filter(ChangeLog.id <= seq).delete()
+        session.commit()
+    prune_snapshots()
+    return path
+
+
+def _snapshots_to_keep(snapshots: list[Snapshot], now: datetime.datetime) -> set[int]:
+    """
+    ids of the snapshots the retention policy keeps: the SNAPSHOT_KEEP_RECENT most
+    recent, the last one each day for SNAPSHOT_KEEP_DAILY days, and the last full
+    snapshot each month for SNAPSHOT_KEEP_MONTHLY months (0 to keep them forever).
+    since a delta can only be restored from its base and every delta before it,
+    those are kept too. exports are kept as long as the full snapshot they're from is
+    """
+    ordered: list[Snapshot] = []
+    exports: list[Snapshot] = []
+    for snap in sorted(snapshots, key=lambda snap: snap.id):
+        (exports if snap.kind == SnapshotKind.EXPORT else ordered).append(snap)
+    keep = {snap.id for snap in ordered[-max(1, settings.SNAPSHOT_KEEP_RECENT) :]}
+
+    # later snapshots overwrite earlier ones, so these are the last of each day/month
+    daily: dict[datetime.date, int] = {}
+    monthly: dict[tuple[int, int], int] = {}
+    for snap in ordered:
+        daily[snap.created_at.date()] = snap.id
+        # full snapshots, so keeping these doesn't mean keeping a chain of deltas
+        if snap.base_id is None:
+            monthly[(snap.created_at.year, snap.created_at.month)] = snap.id
+    cutoff = (now - datetime.timedelta(days=settings.SNAPSHOT_KEEP_DAILY)).date()
+    keep.update(snap_id for day, snap_id in daily.items() if day > cutoff)
+    months = sorted(monthly)
+    if settings.SNAPSHOT_KEEP_MONTHLY > 0:
+        months = months[-settings.SNAPSHOT_KEEP_MONTHLY :]
+    keep.update(monthly[month] for month in months)
+
+    # for each base, the newest delta that's being kept
+    needed: dict[int, int] = {}
+    for snap in ordered:
+        # (only deltas have a base)
+        if snap.id in keep and snap.base_id is not None:
+            needed[snap.base_id] = snap.id
+    for snap in ordered:
+        if snap.id in needed or (
+            snap.base_id in needed and snap.id < needed[snap.base_id]
+        ):
+            keep.add(snap.id)
+    keep.update(snap.id for snap in exports if snap.base_id in keep)
+    return keep
+
+
+def prune_snapshots() -> list[str]:
+    """
+    remove snapshots (the files and their catalog entries) which the retention
+    policy doesn't keep, returning the paths removed. files which aren't in the
+    catalog (backups from before it existed) are left alone
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    removed: list[str] = []
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        snapshots = session.query(Snapshot).all()
+        keep = _snapshots_to_keep(snapshots, now)
+        for snap in snapshots:
+            if snap.id in keep:
                 continue
-            swapuser_lst.append(
-                {
-                    "id": swapuser.id,  # internal id
-                    "user_id": swapuser.user_id,  # discord user id
-                    "name": swapuser.name,
-                    "santa_id": swapuser.santa_id,
-                    "giftee_id": swapuser.giftee_id,
-                    "santa_name": (
-                        user_map[swapuser.santa_id].name
-                        if swapuser.santa_id is not None
-                        else None
-                    ),
-                    "giftee_name": (
-                        user_map[swapuser.giftee_id].name
-                        if swapuser.giftee_id is not None
-                        else None
-                    ),
-                    "letter": swapuser.letter,
-                    "gave_gift": swapuser.gift,
-                    "letterboxd": swapuser.letterboxd_username,
-                    "received_gift": user_map[swapuser.santa_id].gift,
-                    "done": swapuser.done_watching,
-                }
+            logger.info(f"Removing old {snap.kind.value} snapshot {snap.path}")
+            try:
+                os.remove(snap.path)
+            except FileNotFoundError:
+                pass
+            session.delete(snap)
+            removed.append(str(snap.path))
+        session.commit()
+    return removed
+
+
+def _read_delta_header(path: str) -> dict[str, Any]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())  # type: ignore[no-any-return]
+
+
+def restore_snapshot(path: str, out_path: str) -> None:
+    """
+    reconstruct the database as of a snapshot (a full .sqlite copy, or a
+    .delta.jsonl.gz) to out_path. for a delta, this copies its full snapshot and
+    then applies every delta in the same directory up to and including it
+
+    this only uses the files in the snapshot directory, not the snapshots table,
+    so it works even if the live database is gone
+    """
+    import sqlite3
+
+    if os.path.exists(out_path):
+        raise RuntimeError(f"{out_path} already exists, not overwriting it")
+
+    if path.endswith(".sqlite"):
+        shutil.copyfile(path, out_path)
+        return
+
+    target = _read_delta_header(path)
+    directory = os.path.dirname(path) or "."
+    chain = []
+    for name in os.listdir(directory):
+        if not name.endswith(".delta.jsonl.gz"):
+            continue
+        header = _read_delta_header(os.path.join(directory, name))
+        if header["base"] == target["base"] and header["to_seq"] <= target["to_seq"]:
+            chain.append((header["from_seq"], header["to_seq"], name))
+    chain.sort()
+
+    # make sure no deltas are missing between the base and the target
+    seq = target["base_seq"]
+    for from_seq, to_seq, name in chain:
+        if from_seq != seq:
+            raise RuntimeError(
+                f"Missing a delta snapshot for changes {seq} to {from_seq}, before {name}"
             )
+        seq = to_seq
+
+    shutil.copyfile(os.path.join(directory, target["base"]), out_path)
+    conn = sqlite3.connect(out_path)
+    try:
+        for _from_seq, _to_seq, name in chain:
+            logger.info(f"Applying {name}")
+            with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as f:
+                f.readline()  # header
+                for line in f:
+                    record = json.loads(line)
+                    table = record["table"]
+                    key = CHANGE_LOG_TABLES[table]
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE {key} = ?", (record["row_id"],)
+                    )
+                    if (row := record["row"]) is not None:
+                        conn.execute(
+                            f"INSERT INTO {table} ({','.join(row)}) VALUES ({','.join('?' * len(row))})",
+                            tuple(row.values()),
+                        )
+        # this copy doesn't have the changes the triggers logged while applying
+        conn.execute("DELETE FROM change_log")
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"Restored {path} ({len(chain)} deltas) to {out_path}")
+
+
+def create_sqlite_engine(path: str, profile: SqliteProfile) -> Engine:
+    """
+    create an engine for the sqlite database at path, applying the pragmas for profile on connect
+    """
+    eng = create_engine(f"sqlite:///{path}", echo=settings.SQL_ECHO)
+    pragmas = SQLITE_PROFILE_PRAGMAS[profile]
+
+    @event.listens_for(eng, "connect")  # type: ignore[no-untyped-call]
+    def _apply_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return eng
 
-        swapusers_json["swapusers"] = swapuser_lst
 
-    with open(os.path.join(settings.BACKUP_DIR, f"{int(time.time())}.json"), "w") as f:
-        json.dump(swapusers_json, f, indent=4)
+_engine: Engine | None = None
+_engine_lock = threading.Lock()
 
 
-# sqlite database which stores data
-engine = create_engine(
-    f"sqlite:///{settings.SQLITEDB_PATH}",
-    echo=settings.SQL_ECHO,
+def get_engine() -> Engine:
+    """
+    the sqlite database which stores data. this is created (along with any
+    missing tables) the first time its used, not when this module is imported
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                eng = create_sqlite_engine(
+                    settings.SQLITEDB_PATH, settings.SQLITE_PROFILE
+                )
+                metadata.create_all(eng)
+                with eng.begin() as conn:
+                    for trigger in _change_log_triggers():
+                        conn.exec_driver_sql(trigger)
+                _engine = eng
+    return _engine
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+# sqlite only allows one writer at a time, so all writes are serialized through
+# a single thread. reads (checks, embeds, lists) run on a small pool, so the
+# discord event loop never blocks on a commit/fsync
+_writer_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="filmswap-db-write"
+)
+_reader_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="filmswap-db-read"
 )
 
-metadata.create_all(engine)
+
+async def run_db(func: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    """
+    run a db function which writes to the database on the writer thread
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _writer_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def run_db_read(func: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    """
+    run a db function which only reads from the database on the reader pool
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _reader_executor, functools.partial(func, *args, **kwargs)
+    )
@@ -0,0 +1,385 @@
+"""
+Commands which users DM to the bot (>letter, >submit, >write-santa, >write-giftee),
+since unlike slash commands, these let users write out long paragraphs
+
+Each command is registered in DM_COMMANDS with the checks it needs, and dispatch
+runs those against a single UserContext load before calling the handler
+
+Commands are rate limited per user, so one user spamming commands can't use up
+the database/discord rate limits everyone else shares
+"""
+
+from __future__ import annotations
+import math
+import time
+import asyncio
+from dataclasses import dataclass
+from gettext import gettext as _
+from typing import Awaitable, Callable
+
+import discord
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+from .db import (
+    SwapPeriod,
+    UserContext,
+    load_user_context,
+    review_my_gift_embed,
+    review_my_letter_embed,
+    set_gift,
+    set_letter,
+    run_db,
+    run_db_read,
+)
+
+MSG_DESCRIPTION_LIMIT = 4000
+
+# returns an error message to send the user, or None if the command can run
+Check = Callable[[UserContext], str | None]
+DMHandler = Callable[
+    [discord.Client, discord.Message, UserContext, str], Awaitable[None]
+]
+
+
+@dataclass(frozen=True)
+class DMCommand:
+    name: str
+    handler: DMHandler
+    # sent if the user doesn't include any text after the command
+    usage: str
+    # what the text is, for the 'too long' message
+    noun: str = "message"
+    # run in order, after checking the user is active in the swap
+    checks: tuple[Check, ...] = ()
+    max_length: int = MSG_DESCRIPTION_LIMIT
+    # if set, messages sent within DM_COMMAND_DEBOUNCE seconds of each other
+    # are coalesced, only the last one is run
+    debounce: bool = False
+
+
+DM_COMMANDS: dict[str, DMCommand] = {}
+
+
+def dm_command(
+    name: str,
+    *,
+    usage: str,
+    noun: str = "message",
+    checks: tuple[Check, ...] = (),
+    debounce: bool = False,
+) -> Callable[[DMHandler], DMHandler]:
+    def _register(handler: DMHandler) -> DMHandler:
+        DM_COMMANDS[name] = DMCommand(
+            name=name,
+            handler=handler,
+            usage=usage,
+            noun=noun,
+            checks=checks,
+            debounce=debounce,
+        )
+        return handler
+
+    return _register
+
+
+class RateLimiter:
+    """
+    a token bucket per key, each key can be used burst times in a row, and
+    then refills at rate tokens per second
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        # key -> (tokens, when tokens was last updated)
+        self._buckets: dict[tuple[int, str], tuple[float, float]] = {}
+        # keys which have been denied since they last got a token
+        self._denied: set[tuple[int, str]] = set()
+
+    def acquire(self, key: tuple[int, str]) -> float:
+        """
+        take a token for key, returns 0 if one was available, otherwise how
+        many seconds until there is one
+        """
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        self._denied.discard(key)
+        if len(self._buckets) > 10000:
+            self._prune(now)
+        return 0
+
+    def _prune(self, now: float) -> None:
+        # full buckets are the same as not having one
+        for key, (tokens, updated_at) in list(self._buckets.items()):
+            if tokens + (now - updated_at) * self.rate >= self.burst:
+                del self._buckets[key]
+                self._denied.discard(key)
+
+    def first_denial(self, key: tuple[int, str]) -> bool:
+        """
+        true the first time key is denied since it last got a token, so the
+        user is only told to slow down once
+        """
+        if key in self._denied:
+            return False
+        self._denied.add(key)
+        return True
+
+
+rate_limiter = RateLimiter(
+    settings.DM_COMMAND_PER_MINUTE / 60, settings.DM_COMMAND_BURST
+)
+# (user id, command) -> the latest message, for debounced commands waiting to run
+_pending: dict[tuple[int, str], tuple[discord.Message, UserContext, str]] = {}
+_debounce_tasks: set[asyncio.Task[None]] = set()
+
+
+async def _run_debounced(
+    bot: discord.Client, command: DMCommand, key: tuple[int, str]
+) -> None:
+    await asyncio.sleep(settings.DM_COMMAND_DEBOUNCE)
+    message, user_ctx, text = _pending.pop(key)
+    try:
+        await command.handler(bot, message, user_ctx, text)
+    except Exception as e:
+        logger.exception(
+            f"Error running {command.name} for {message.author.id}: {e}", exc_info=True
+        )
+        await message.author.send(f"Error: {e}")
+
+
+async def _rate_limited(message: discord.Message, command: DMCommand) -> bool:
+    if settings.DM_COMMAND_PER_MINUTE <= 0:
+        return False
+    key = (message.author.id, command.name)
+    if (wait := rate_limiter.acquire(key)) == 0:
+        return False
+    logger.info(
+        f"User {message.author.id} is rate limited for {command.name}, {wait:.1f}s left"
+    )
+    if rate_limiter.first_denial(key):
+        await message.author.send(
+            f"You're using {command.name} too quickly, try again in {math.ceil(wait)} seconds"
+        )
+    return True
+
+
+async def dispatch(bot: discord.Client, message: discord.Message) -> None:
+    """
+    run the DM command in message, if there is one
+    """
+    content = message.content.strip()
+    if not content.startswith(">"):
+        return
+    parts = content.split(maxsplit=1)
+    command = DM_COMMANDS.get(parts[0])
+    if command is None:
+        logger.info(
+            f"User {message.author.id} {message.author.display_name} sent unknown command {content}"
+        )
+        await message.author.send(
+            "Unknown command. Use `/help` to see a list of commands"
+        )
+        return
+
+    key = (message.author.id, command.name)
+    coalesce = command.debounce and settings.DM_COMMAND_DEBOUNCE > 0
+    # only scheduling a debounced run takes a token, messages which just replace
+    # the one waiting to run (see below) don't count towards the limit
+    if not (coalesce and key in _pending) and await _rate_limited(message, command):
+        return
+
+    logger.info(f"User {message.author.id} running {command.name}")
+    user_ctx = await run_db_read(load_user_context, message.author.id)
+    if error := user_ctx.error:
+        await message.author.send(error)
+        return
+
+    for check in command.checks:
+        if error := check(user_ctx):
+            logger.info(
+                f"User {message.author.id} tried to run {command.name} but failed {check.__name__}"
+            )
+            await message.author.send(error)
+            return
+
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        logger.info(
+            f"User {message.author.id} tried to run {command.name} but didn't provide any text"
+        )
+        await message.author.send(command.usage)
+        return
+
+    if len(text) > command.max_length:
+        logger.info(
+            f"User {message.author.id} tried to run {command.name} but their {command.noun} was too long"
+        )
+        await message.author.send(
+            f"Sorry, your {command.noun} is too long. It must be less than {command.max_length} characters (it is currently {len(text)} characters)"
+        )
+        return
+
+    if coalesce:
+        # if one is already waiting to run, this replaces the message it runs with
+        waiting = key in _pending
+        _pending[key] = (message, user_ctx, text)
+        if not waiting:
+            task = asyncio.create_task(_run_debounced(bot, command, key))
+            _debounce_tasks.add(task)
+            task.add_done_callback(_debounce_tasks.discard)
+        return
+
+    await command.handler(bot, message, user_ctx, text)
+
+
+# checks
+
+
+def letter_editable(ctx: UserContext) -> str | None:
+    # users can set their letter late (outside the JOIN period), but can't change it
+    assert ctx.user is not None
+    if ctx.period != SwapPeriod.JOIN and ctx.user.letter is not None:
+        return "Sorry, you can't change your letter right now. Wait till the beginning of the next swap to change it.\nIf you want to review your letter, you can use `/review-letter`"
+    return None
+
+
+def has_giftee(ctx: UserContext) -> str | None:
+    assert ctx.user is not None
+    if ctx.user.giftee_id is None:
+        return "Sorry, you can't set your gift until you've been assigned a giftee"
+    return None
+
+
+def gift_editable(ctx: UserContext) -> str | None:
+    if ctx.period == SwapPeriod.JOIN:
+        return "Sorry, you can't change your gift right now. Wait till the next 'swap' period starts to set your gift"
+    # we should not allow people who have already submitted to change during the watch period,
+    # but if they haven't submitted yet, they can submit at any time (to allow latecomers to join later)
+    if ctx.period == SwapPeriod.WATCH and ctx.has_set_gift:
+        return "Sorry, you can't change your gift right now. If you need to communicate with your giftee, you can use >write-giftee to send them a message.\nIf you want to review the gift you sent, use `/review-gift`"
+    return None
+
+
+def can_message_santa(ctx: UserContext) -> str | None:
+    if ctx.santa is None:
+        return (
+            "You can only send a message to your santa after you've been assigned one"
+        )
+    return None
+
+
+def can_message_giftee(ctx: UserContext) -> str | None:
+    if ctx.giftee is None:
+        return (
+            "You can only send a message to your giftee after you've been assigned one"
+        )
+    return None
+
+
+# commands
+
+
+@dm_command(
+    ">letter",
+    usage=_(
+        "Use `>letter [text]` to set your letter, where [text] is what kinds of films you like/dislike/want from your santa. If you have a letterboxd/imdb you can include that as well"
+    ),
+    noun="letter",
+    checks=(letter_editable,),
+    debounce=True,
+)
+async def letter(
+    bot: discord.Client, message: discord.Message, ctx: UserContext, text: str
+) -> None:
+    assert ctx.user is not None
+    logger.info(f"User {message.author.id} setting letter to {text}")
+    await run_db(set_letter, message.author.id, text)
+    # reflect the write on the loaded row, so the review doesn't need another query
+    ctx.user.letter = text
+    await message.reply("Your letter has been set, your santa will see:")
+    await message.reply(embed=review_my_letter_embed(message.author.id, context=ctx))
+
+
+@dm_command(
+    ">submit",
+    usage=_(
+        "Use `>submit [text]` to submit your gift, where [text] is your gift/film recommendation"
+    ),
+    noun="gift",
+    checks=(has_giftee, gift_editable),
+)
+async def submit(
+    bot: discord.Client, message: discord.Message, ctx: UserContext, text: str
+) -> None:
+    assert ctx.user is not None
+    logger.info(
+        f"User {message.author.id} setting gift for {ctx.user.giftee_id} to {text}"
+    )
+    await run_db(set_gift, message.author.id, text)
+    await message.reply(
+        "Your gift has been set, when the watch period starts your giftee will see:"
+    )
+    ctx.user.gift = text
+    await message.reply(embed=review_my_gift_embed(message.author.id, context=ctx))
+    await message.reply(
+        "Since you can change your gift by running /submit again before the SWAP period ends, your giftee does not receive their gift immediately.\nIf you're confident in your gift or want to send it early, you can also use >write-giftee to send it to your giftee early"
+    )
+
+
+async def _forward(
+    bot: discord.Client,
+    message: discord.Message,
+    recipient_id: int,
+    recipient: str,
+    embed: discord.Embed,
+) -> None:
+    try:
+        user = await bot.fetch_user(recipient_id)
+    except Exception:
+        logger.info(
+            f"User {message.author.id} tried to send message to {recipient} but their {recipient}'s ID {recipient_id} is invalid"
+        )
+        await message.author.send(
+            f"There was an error messaging your {recipient}, could not associate their ID with a discord account."
+        )
+        return
+    logger.info(
+        f"User {message.author.id} {message.author.display_name} sending message to {recipient} {recipient_id} {embed.description}"
+    )
+    await user.send(embed=embed)
+    await message.author.send("Your message has been sent")
+
+
+@dm_command(
+    ">write-santa",
+    usage="Use >write-santa [text] to send a message to your santa, where [text] is your message",
+    checks=(can_message_santa,),
+)
+async def write_santa(
+    bot: discord.Client, message: discord.Message, ctx: UserContext, text: str
+) -> None:
+    assert ctx.santa is not None
+    embed = discord.Embed(title="Your giftee sent you a message", description=text)
+    embed.set_footer(text="To reply, use >write-giftee [text]")
+    await _forward(bot, message, ctx.santa.user_id, "santa", embed)
+
+
+@dm_command(
+    ">write-giftee",
+    usage="Use >write-giftee [text] to send a message to your giftee, where [text] is your message",
+    checks=(can_message_giftee,),
+)
+async def write_giftee(
+    bot: discord.Client, message: discord.Message, ctx: UserContext, text: str
+) -> None:
+    assert ctx.giftee is not None
+    embed = discord.Embed(title="Your santa sent you a message", description=text)
+    embed.set_footer(text="To reply, use >write-santa [text]")
+    await _forward(bot, message, ctx.giftee.user_id, "giftee", embed)
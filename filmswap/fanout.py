@@ -0,0 +1,166 @@
+"""
+Sends DMs to lots of users at once, e.g. letters at the start of the SWAP period
+
+Messages that have to be delivered even if the bot restarts (period post hook, ban
+notifications) are queued in the outbox table, and sent by the OutboxWorker
+
+discord.py already serializes requests per rate-limit bucket (and retries a few times
+when it gets a 429), so this just bounds how many DMs are in flight at once, and backs
+off (pausing every sender, not just the one that got rate limited) if discord still
+returns a 429 after that
+"""
+
+from __future__ import annotations
+import time
+import random
+import asyncio
+
+import discord
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+from .db import (
+    OutboxItem,
+    recover_outbox,
+    claim_outbox,
+    mark_outbox_sent,
+    mark_outbox_failed,
+    run_db,
+)
+
+
+def _retry_after(e: discord.HTTPException, attempt: int) -> float:
+    """
+    how long to wait before retrying, uses discords Retry-After header if its there
+    """
+    retry_after = None
+    headers = getattr(e.response, "headers", None)
+    if headers is not None:
+        try:
+            retry_after = float(headers.get("Retry-After", ""))
+        except ValueError:
+            pass
+    if retry_after is None:
+        retry_after = 2**attempt
+    # jitter, so all the waiting senders don't retry at the same instant
+    return retry_after + random.uniform(0, 1)
+
+
+class DMFanout:
+    def __init__(
+        self,
+        bot: discord.Client,
+        *,
+        concurrency: int | None = None,
+        max_retries: int | None = None,
+    ) -> None:
+        self.bot = bot
+        self.concurrency = concurrency or settings.DM_FANOUT_CONCURRENCY
+        self.max_retries = (
+            max_retries if max_retries is not None else settings.DM_FANOUT_MAX_RETRIES
+        )
+        # set when a sender gets rate limited, every sender waits until then
+        self._paused_until = 0.0
+
+    async def _wait_if_paused(self) -> None:
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def deliver(
+        self,
+        user_id: int,
+        *,
+        content: str | None = None,
+        embed: discord.Embed | None = None,
+    ) -> None:
+        """
+        DM a user, retrying with backoff if rate limited
+        """
+        user = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
+        attempt = 0
+        while True:
+            await self._wait_if_paused()
+            try:
+                await user.send(content=content, embed=embed)  # type: ignore[arg-type]
+                return
+            except discord.Forbidden:
+                # user has DMs closed/blocked the bot, retrying won't help
+                raise
+            except discord.HTTPException as e:
+                if (e.status != 429 and e.status < 500) or attempt >= self.max_retries:
+                    raise
+                delay = _retry_after(e, attempt)
+                logger.warning(
+                    f"Got {e.status} sending DM to {user_id}, pausing DMs for {delay:.1f}s"
+                )
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                attempt += 1
+
+
+class OutboxWorker:
+    """
+    Drains the outbox table in the background. Each message is marked as SENDING
+    before its sent, so after a restart nothing is sent twice (see recover_outbox)
+    """
+
+    def __init__(self, bot: discord.Client) -> None:
+        self.fanout = DMFanout(bot)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def notify(self) -> None:
+        """
+        call after queuing messages, so they're sent now instead of on the next poll
+        """
+        self._wakeup.set()
+
+    async def _deliver(self, item: OutboxItem) -> None:
+        try:
+            await self.fanout.deliver(
+                item.user_id, content=item.content, embed=item.embed
+            )
+        except (discord.Forbidden, discord.NotFound) as e:
+            # DMs closed, or the account is deleted/the id is wrong
+            logger.warning(f"Cannot DM {item.user_id}, not retrying: {e}")
+            await run_db(mark_outbox_failed, item.id, str(e), None)
+        except Exception as e:
+            retry_in: float | None = None
+            if item.attempts < settings.OUTBOX_MAX_ATTEMPTS:
+                retry_in = 30 * 2 ** (item.attempts - 1)
+            logger.exception(
+                f"Error sending outbox message {item.id} to {item.user_id} (attempt {item.attempts}), retrying in {retry_in}s: {e}",
+                exc_info=True,
+            )
+            await run_db(mark_outbox_failed, item.id, str(e), retry_in)
+        else:
+            await run_db(mark_outbox_sent, item.id)
+
+    async def _run(self) -> None:
+        await run_db(recover_outbox)
+        logger.info("Started outbox worker")
+        while True:
+            try:
+                items = await run_db(claim_outbox, self.fanout.concurrency * 4)
+            except Exception as e:
+                logger.exception(f"Error claiming outbox messages: {e}", exc_info=True)
+                items = []
+            if items:
+                semaphore = asyncio.Semaphore(self.fanout.concurrency)
+
+                async def _bounded(item: OutboxItem) -> None:
+                    async with semaphore:
+                        await self._deliver(item)
+
+                await asyncio.gather(*(_bounded(item) for item in items))
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=settings.OUTBOX_POLL_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
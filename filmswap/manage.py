@@ -6,70 +6,192 @@ import os
 import calendar
 import datetime
 import random
-from pathlib import Path
-from typing import Literal
-
-import networkx as nx  # type: ignore[import]
-import matplotlib.pyplot as plt  # type: ignore[import]
+import time
+import tempfile
+from dataclasses import dataclass
+from typing import Any, Iterator, Literal
 
 import discord
 from discord.ext import commands
+from sqlalchemy import update, bindparam, select, case, and_, func
 
 from logzero import logger  # type: ignore[import]
 
 from gettext import gettext as _
 from .settings import settings
 from .db import (
-    snapshot_database,
+    take_snapshot,
+    export_snapshot,
+    record_export,
     Session,
     SwapPeriod,
     Swap,
     Banned,
     get_santa,
     get_giftee,
-    read_giftee_letter,
-    receive_gift_embed,
     ban_user,
     unban_user,
     join_swap,
     restore_letter,
     set_gift_done,
-    engine,
+    get_engine,
     SwapUser,
+    run_db,
+    run_db_read,
+    _enqueue_messages,
+    outbox_batch_status,
+    outbox_failed_recipients,
+    OutboxStatus,
+    embed_cache,
+    participants,
+)
+from .fanout import OutboxWorker
+from .reveal import (
+    GRAPH_LAYOUTS,
+    Connection,
+    decompose_cycles,
+    pretty_cycle,
+    render_graphs,
+    graph_filename,
+    matching_hash,
+    cached_output,
+    evict_stale,
 )
 from ._types import ClientT
 
 DISABLE_UNMATCH = True
 
-
-def list_users() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).all()  # type: ignore[no-any-return]
-
-
-def havent_set_letter() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(letter=None).all()  # type: ignore[no-any-return]
+# rows fetched at a time when streaming the info report
+REPORT_BATCH_SIZE = 1000
 
 
-def havent_submitted_gift() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(gift=None).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
+# (user_id, name), for listing users without loading their letters/gifts
+UserName = tuple[int, str]
 
 
-def users_without_giftees() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(giftee_id=None).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
-
-
-def users_without_santas() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(santa_id=None).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
-
-
-def users_not_done_watching() -> list[SwapUser]:
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        return session.query(SwapUser).filter_by(done_watching=False).filter(SwapUser.letter.is_not(None)).all()  # type: ignore[no-any-return,attr-defined]
+def _iter_user_names(session: Session, *criteria: Any) -> Iterator[UserName]:
+    for user_id, name in (
+        session.query(SwapUser.user_id, SwapUser.name)
+        .filter(*criteria)
+        .yield_per(REPORT_BATCH_SIZE)
+    ):
+        yield user_id, name
+
+
+def matched_users() -> tuple[list[Connection], dict[int, str]]:
+    """
+    (user_id, santa_id, giftee_id) for everyone who has both a santa and giftee, and their names
+    """
+    connections: list[Connection] = []
+    names: dict[int, str] = {}
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        for user_id, name, santa_id, giftee_id in (
+            session.query(
+                SwapUser.user_id, SwapUser.name, SwapUser.santa_id, SwapUser.giftee_id
+            )
+            .filter(SwapUser.santa_id.is_not(None), SwapUser.giftee_id.is_not(None))  # type: ignore[attr-defined]
+            .order_by(SwapUser.id)
+        ):
+            connections.append((user_id, santa_id, giftee_id))
+            names[user_id] = name
+    return connections, names
+
+
+@dataclass
+class SwapCounts:
+    users: int
+    without_letters: int
+    # the rest of these only count active users (who have letters)
+    without_gifts: int
+    without_giftees: int
+    without_santas: int
+    not_done_watching: int
+    banned: int
+
+
+def swap_counts(session: Session | None = None) -> SwapCounts:
+    """
+    all the counts for the info embed, in one aggregate query
+    """
+    if session is None:
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            return swap_counts(session)
+
+    has_letter = SwapUser.letter.is_not(None)  # type: ignore[attr-defined]
+
+    def _count(*criteria: Any) -> Any:
+        return func.coalesce(func.sum(case((and_(*criteria), 1), else_=0)), 0)  # type: ignore[arg-type]
+
+    stmt = select(
+        func.count(SwapUser.id),
+        _count(SwapUser.letter.is_(None)),  # type: ignore[attr-defined,no-untyped-call]
+        _count(has_letter, SwapUser.gift.is_(None)),  # type: ignore[attr-defined,no-untyped-call]
+        _count(has_letter, SwapUser.giftee_id.is_(None)),  # type: ignore[attr-defined,no-untyped-call]
+        _count(has_letter, SwapUser.santa_id.is_(None)),  # type: ignore[attr-defined,no-untyped-call]
+        _count(has_letter, SwapUser.done_watching.is_(False)),  # type: ignore[attr-defined,no-untyped-call]
+        select(func.count()).select_from(Banned).scalar_subquery(),  # type: ignore[attr-defined,arg-type]
+    )
+    return SwapCounts(*session.execute(stmt).one())
+
+
+def _iter_report(session: Session) -> Iterator[str]:
+    """
+    the sections of the info report, streamed from the database
+    """
+    counts = swap_counts(session)
+    has_letter = SwapUser.letter.is_not(None)  # type: ignore[attr-defined]
+    sections: list[tuple[str, list[Any]]] = [
+        (f"**{counts.users}** users are in the swap", []),
+        (
+            f"**{counts.without_letters}** users have not submitted letters",
+            [SwapUser.letter.is_(None)],  # type: ignore[attr-defined,no-untyped-call]
+        ),
+        (
+            f"**{counts.without_gifts}** users [who have letters] have not submitted gifts",
+            [has_letter, SwapUser.gift.is_(None)],  # type: ignore[attr-defined,no-untyped-call]
+        ),
+        (
+            f"**{counts.not_done_watching}** users [who have letters] have not set /done-watching",
+            [has_letter, SwapUser.done_watching.is_(False)],  # type: ignore[attr-defined,no-untyped-call]
+        ),
+        (
+            f"**{counts.without_giftees}** users [who have letters] do not have giftees",
+            [has_letter, SwapUser.giftee_id.is_(None)],  # type: ignore[attr-defined,no-untyped-call]
+        ),
+        (
+            f"**{counts.without_santas}** users [who have letters] do not have santas",
+            [has_letter, SwapUser.santa_id.is_(None)],  # type: ignore[attr-defined,no-untyped-call]
+        ),
+    ]
+    for header, criteria in sections:
+        yield f"{header}\n\n"
+        for user_id, name in _iter_user_names(session, *criteria):
+            yield f"{user_id} {name}\n"
+        yield "\n"
+
+    yield f"**{counts.banned}** users are banned\n\n"
+    for (user_id,) in session.query(Banned.user_id).yield_per(REPORT_BATCH_SIZE):
+        yield f"{user_id}\n"
+
+
+def write_report() -> io.BufferedRandom:
+    """
+    writes the info report to a temporary file, and returns it seeked to the
+    start. the caller should close it
+    """
+    # a real file (discord.File only reads file objects which are io.IOBase, which
+    # SpooledTemporaryFile isn't before python 3.11), so the report isn't kept in memory
+    f = tempfile.TemporaryFile()
+    try:
+        # one session, so the counts and lists are from the same snapshot
+        with Session(get_engine()) as session:  # type: ignore[attr-defined]
+            for chunk in _iter_report(session):
+                f.write(chunk.encode("utf-8"))
+        f.seek(0)
+    except Exception:
+        f.close()
+        raise
+    return f
 
 
 def filter_emoji(s: str) -> str:
@@ -109,7 +231,7 @@ class JoinSwapButton(discord.ui.View):
         )
 
         try:
-            join_swap(interaction.user.id, interaction.user.display_name)
+            await run_db(join_swap, interaction.user.id, interaction.user.display_name)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(str(e), ephemeral=True)
@@ -124,7 +246,7 @@ class JoinSwapButton(discord.ui.View):
             )
         )
 
-        if restore_letter(interaction.user.id):
+        if await run_db(restore_letter, interaction.user.id):
             await interaction.user.send(
                 "Your old letter has been restored, you can use `/review-letter` to read it, or >letter to update it"
             )
@@ -173,73 +295,173 @@ async def error_if_not_admin(interaction: discord.Interaction[ClientT]) -> bool:
     return False
 
 
-async def update_usernames(guild: discord.Guild) -> None:
+def _list_user_names() -> list[tuple[int, str]]:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        return [
+            (user_id, name)
+            for user_id, name in session.query(SwapUser.user_id, SwapUser.name)
+        ]
+
+
+def _save_usernames(names: dict[int, str], missing: list[int]) -> None:
+    """
+    save new display names, and clear the letters of users who left the server
+
+    only rows which actually change are written, and only those users (and their
+    santa/giftee, whose embeds show their name/letter) are invalidated in embed_cache
+    """
+    left = set(missing)
+    ids = list(names) + missing
+    if not ids:
+        return
+    table = SwapUser.__table__  # type: ignore[attr-defined]
+    renamed: dict[int, str] = {}
+    cleared: list[int] = []
+    related: list[int | None] = []
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
+        for user_id, name, letter, santa_id, giftee_id in session.query(
+            SwapUser.user_id,
+            SwapUser.name,
+            SwapUser.letter,
+            SwapUser.santa_id,
+            SwapUser.giftee_id,
+        ).filter(
+            SwapUser.user_id.in_(ids)  # type: ignore[attr-defined]
+        ):
+            if user_id in names and names[user_id] != name:
+                renamed[user_id] = names[user_id]
+            elif user_id in left and letter is not None:
+                cleared.append(user_id)
+            else:
+                continue
+            related.extend((user_id, santa_id, giftee_id))
+        if renamed:
+            session.execute(
+                update(table)
+                .where(table.c.user_id == bindparam("uid"))
+                .values(name=bindparam("new_name")),
+                [{"uid": uid, "new_name": name} for uid, name in renamed.items()],
+            )
+        if cleared:
+            session.execute(
+                update(table).where(table.c.user_id.in_(cleared)).values(letter=None)
+            )
+        session.commit()
+    logger.info(f"Saved {len(renamed)} changed names, cleared {len(cleared)} letters")
+    embed_cache.bump(*related)
+
+
+@dataclass
+class UsernameSync:
+    users: int = 0
+    from_cache: int = 0
+    fetched: int = 0
+    changed: int = 0
+    missing: int = 0
+
+    def describe(self) -> str:
+        # previously, every user was fetched over HTTP
+        return f"Checked {self.users} users ({self.from_cache} from the member cache, {self.fetched} fetched), updated {self.changed} names, {self.missing} not in the server. Saved {self.users - self.fetched} API calls"
+
+
+async def update_usernames(guild: discord.Guild) -> UsernameSync:
+    """
+    Update names from the guilds member cache (we have the members intent), only
+    fetching members over HTTP if they aren't cached
+    """
     logger.info("Starting to update usernames...")
-    with Session(engine) as session:  # type: ignore[attr-defined]
-        users = session.query(SwapUser).all()
-        logger.info(f"Checking usernames for {len(users)} users...")
-        for user in users:
+    if not guild.chunked:
+        logger.info("Requesting guild members from the gateway...")
+        await guild.chunk()
+    users = await run_db_read(_list_user_names)
+    participants.reset(user_id for user_id, _ in users)
+    logger.info(f"Checking usernames for {len(users)} users...")
+    result = UsernameSync(users=len(users))
+    names: dict[int, str] = {}
+    missing: list[int] = []
+    for user_id, name in users:
+        member = guild.get_member(user_id)
+        if member is not None:
+            result.from_cache += 1
+        else:
+            result.fetched += 1
             try:
-                member = await guild.fetch_member(user.user_id)
+                member = await guild.fetch_member(user_id)
             except discord.NotFound:
                 logger.info(
-                    f"Could not find member {user.user_id} {user.name}, setting letter to None and skipping"
+                    f"Could not find member {user_id} {name}, setting letter to None and skipping"
                 )
-                user.letter = None
-                session.add(user)
+                missing.append(user_id)
                 continue
 
-            if member.display_name != user.name:
-                logger.info(
-                    f"Updating {user.user_id} {user.name} to {member.display_name}"
-                )
-            user.name = member.display_name
-            session.add(user)
+        if member.display_name != name:
+            logger.info(f"Updating {user_id} {name} to {member.display_name}")
+            names[user_id] = member.display_name
 
-            await asyncio.sleep(0.5)
+    result.changed = len(names)
+    result.missing = len(missing)
+    await run_db(_save_usernames, names, missing)
 
-        session.commit()
+    logger.info(f"Done updating usernames: {result.describe()}")
+    return result
 
-    logger.info("Done updating usernames")
 
+class MemberUpdateBatcher:
+    """
+    Collects display name changes/members leaving from gateway events, and writes
+    them in one batch a few seconds after the first change, instead of one write per event
 
-async def _fix_connections_after_ban_or_leave(user_id: int, bot: commands.Bot) -> None:
-    # if the user is banned, we need to remove them from the swap
-    # but this also means that if they had a santa/giftee, we need to fix the
-    # dangling connections
-    #
-    # A -> B -> C
-    # say A was gifting to B, and B was gifting to C
-    #
-    # if we ban B, we need to make A gift to C instead
-    #
-    # then, we should send a message to A saying that their giftee was banned, and they
-    # should run /read again to gift to their new giftee
-    #
-    # similarly, we should send a message to C saying that their santa was banned, and they
-    # should receive their gift shortly (it might be after the watch period starts, but hopefully soon)
+    Events for members who aren't in the swap (most of the server) are dropped here,
+    so they don't cause a write at all
+    """
 
-    santa = get_santa(user_id)
-    giftee = get_giftee(user_id)
+    def __init__(self, delay: float | None = None) -> None:
+        self.delay = delay if delay is not None else settings.MEMBER_UPDATE_DEBOUNCE
+        self._names: dict[int, str] = {}
+        self._removed: set[int] = set()
+        self._flush_task: asyncio.Task[None] | None = None
 
-    if santa is None or giftee is None:
-        raise RuntimeError(
-            f"WARNING: while banning user {user_id}, they did not have both a santa and giftee, so did not fix/reroute any dangling connections.\n\nIf its currently the JOIN phase, this is fine, but if its the SWAP/WATCH phase, something may have broken and a user might be assigned a banned user as their giftee/santa"
-        )
+    def name_changed(self, user_id: int, name: str) -> None:
+        if user_id not in participants:
+            return
+        self._removed.discard(user_id)
+        self._names[user_id] = name
+        self._schedule()
 
-    logger.info(f"Banned users' santa was {santa.user_id} {santa.name}")
-    logger.info(f"Banned users' giftee was {giftee.user_id} {giftee.name}")
+    def member_removed(self, user_id: int) -> None:
+        if user_id not in participants:
+            return
+        self._names.pop(user_id, None)
+        self._removed.add(user_id)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.delay)
+        names, removed = self._names, self._removed
+        self._names, self._removed = {}, set()
+        # anything that comes in while writing schedules another flush
+        self._flush_task = None
+        logger.info(
+            f"Saving {len(names)} changed names, {len(removed)} members that left"
+        )
+        try:
+            await run_db(_save_usernames, names, list(removed))
+        except Exception as e:
+            logger.exception(f"Error saving member updates: {e}", exc_info=True)
 
-    assert isinstance(santa.user_id, int)
-    assert isinstance(giftee.user_id, int)
 
-    with Session(engine) as session:  # type: ignore[attr-defined]
+def _reroute_santa_to_giftee(banned_id: int, santa_id: int, giftee_id: int) -> None:
+    with Session(get_engine()) as session:  # type: ignore[attr-defined]
         banned_user_santa = (
-            session.query(SwapUser).filter(SwapUser.user_id == santa.user_id).one()
+            session.query(SwapUser).filter(SwapUser.user_id == santa_id).one()
         )
 
         banned_user_giftee = (
-            session.query(SwapUser).filter(SwapUser.user_id == giftee.user_id).one()
+            session.query(SwapUser).filter(SwapUser.user_id == giftee_id).one()
         )
 
         # update the santas giftee to be the banned users user id
@@ -265,30 +487,118 @@ async def _fix_connections_after_ban_or_leave(user_id: int, bot: commands.Bot) -
         session.add(banned_user_santa)
         session.add(banned_user_giftee)
 
+        # send message to new santa saying that their giftee was banned
+        # and they should run /read again to gift to their new giftee
+        _enqueue_messages(
+            session,
+            f"ban-{banned_id}-{int(time.time())}",
+            [
+                (
+                    santa_id,
+                    "Your giftee was banned from the swap. You have been assigned a new giftee. Please run /read again to read their letter, and send them a gift.\nIf you're not able to set a gift, you can use >write-giftee to send a message to them instead",
+                    None,
+                ),
+                (
+                    giftee_id,
+                    "Your santa was banned from the swap. You will receive your gift shortly, but it might be after the watch period starts. If you don't have it soon, feel free to mention it in the channel",
+                    None,
+                ),
+            ],
+        )
+
         session.commit()
+    embed_cache.clear()
+
+
+async def _fix_connections_after_ban_or_leave(
+    user_id: int, outbox: OutboxWorker
+) -> None:
+    # if the user is banned, we need to remove them from the swap
+    # but this also means that if they had a santa/giftee, we need to fix the
+    # dangling connections
+    #
+    # A -> B -> C
+    # say A was gifting to B, and B was gifting to C
+    #
+    # if we ban B, we need to make A gift to C instead
+    #
+    # then, we should send a message to A saying that their giftee was banned, and they
+    # should run /read again to gift to their new giftee
+    #
+    # similarly, we should send a message to C saying that their santa was banned, and they
+    # should receive their gift shortly (it might be after the watch period starts, but hopefully soon)
+    #
+    # the messages are queued in the outbox in the same transaction as the reroute, so they're
+    # sent even if the bot restarts
+
+    santa = await run_db_read(get_santa, user_id)
+    giftee = await run_db_read(get_giftee, user_id)
+
+    if santa is None or giftee is None:
+        raise RuntimeError(
+            f"WARNING: while banning user {user_id}, they did not have both a santa and giftee, so did not fix/reroute any dangling connections.\n\nIf its currently the JOIN phase, this is fine, but if its the SWAP/WATCH phase, something may have broken and a user might be assigned a banned user as their giftee/santa"
+        )
+
+    logger.info(f"Banned users' santa was {santa.user_id} {santa.name}")
+    logger.info(f"Banned users' giftee was {giftee.user_id} {giftee.name}")
+
+    assert isinstance(santa.user_id, int)
+    assert isinstance(giftee.user_id, int)
+
+    await run_db(_reroute_santa_to_giftee, user_id, santa.user_id, giftee.user_id)
 
     # we should confirm that the banned user ID appears *nowhere* in the swap
-    # if it does, then we have a bug
-    for user in list_users():
-        assert user.user_id != user_id, f"User {user_id} still appears in the swap"
-        assert user.santa_id != user_id, f"User {user_id} still appears as a santa"
-        assert user.giftee_id != user_id, f"User {user_id} still appears as a giftee"
-
-    # send message to new santa saying that their giftee was banned
-    # and they should run /read again to gift to their new giftee
-
-    santa_discord_user = await bot.fetch_user(santa.user_id)
-    await asyncio.sleep(1)
-    giftee_discord_user = await bot.fetch_user(giftee.user_id)
-    await asyncio.sleep(1)
-
-    await santa_discord_user.send(
-        "Your giftee was banned from the swap. You have been assigned a new giftee. Please run /read again to read their letter, and send them a gift.\nIf you're not able to set a gift, you can use >write-giftee to send a message to them instead"
-    )
-    await asyncio.sleep(1)
-    await giftee_discord_user.send(
-        "Your santa was banned from the swap. You will receive your gift shortly, but it might be after the watch period starts. If you don't have it soon, feel free to mention it in the channel"
-    )
+    # and that everyone is still in a cycle. if not, then we have a bug
+    connections, _names = await run_db_read(matched_users)
+    try:
+        decompose_cycles(connections)
+    except ValueError as e:
+        raise RuntimeError(
+            f"After rerouting around banned user {user_id}, connections are broken: {e}"
+        ) from e
+    assert all(
+        user_id not in conn for conn in connections
+    ), f"User {user_id} still appears in the swap"
+
+    outbox.notify()
+
+
+_report_tasks: set[asyncio.Task[None]] = set()
+
+
+async def _report_outbox_batch(
+    interaction: discord.Interaction[ClientT], batch: str, msg: str
+) -> None:
+    """
+    edit the progress of sending an outbox batch into the interaction response,
+    and DM the admin once everything in the batch was sent (or failed)
+    """
+    started_at = time.perf_counter()
+    while True:
+        await asyncio.sleep(10)
+        counts = await run_db_read(outbox_batch_status, batch)
+        total = sum(counts.values())
+        sent, failed = counts[OutboxStatus.SENT], counts[OutboxStatus.FAILED]
+        progress = f"{sent + failed}/{total} done in {time.perf_counter() - started_at:.0f}s: {sent} sent, {failed} failed"
+        if counts[OutboxStatus.PENDING] + counts[OutboxStatus.SENDING] > 0:
+            try:
+                await interaction.edit_original_response(content=f"{msg}: {progress}")
+            except discord.HTTPException as e:
+                # interaction tokens expire after 15 minutes
+                logger.warning(f"Could not edit response with outbox progress: {e}")
+            continue
+        break
+
+    summary = f"Finished outbox batch {batch}, {progress}"
+    if failed:
+        failed_ids = await run_db_read(outbox_failed_recipients, batch)
+        summary += "\nFailed to DM: " + ", ".join(str(u) for u in failed_ids)
+    logger.info(summary)
+    try:
+        await interaction.edit_original_response(content=f"{msg}: {progress}")
+    except discord.HTTPException as e:
+        logger.warning(f"Could not edit response with outbox progress: {e}")
+    await interaction.user.send(summary)
 
 
 # create group to manage swaps
@@ -298,6 +608,11 @@ class Manage(discord.app_commands.Group):
         assert isinstance(self._bot, commands.Bot)  # type: ignore
         return self._bot  # type: ignore
 
+    def get_outbox(self) -> OutboxWorker:
+        assert hasattr(self, "_outbox")
+        assert isinstance(self._outbox, OutboxWorker)  # type: ignore
+        return self._outbox  # type: ignore
+
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="create", description="Create the swap for this server"
     )
@@ -306,7 +621,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            Swap.create_swap()
+            await run_db(Swap.create_swap)
             await interaction.response.send_message(
                 "Created swap. Remember to run the 'set-channel' command to set the channel where the swap will take place",
                 ephemeral=True,
@@ -317,64 +632,35 @@ class Manage(discord.app_commands.Group):
             return
 
     async def _set_period_post_hook(
-        self, interaction: discord.Interaction[ClientT], successfully_set_to: SwapPeriod
+        self,
+        interaction: discord.Interaction[ClientT],
+        successfully_set_to: SwapPeriod,
+        batch: str,
+        msg: str,
     ) -> None:
         """
         This handles sending out the letters to users when the swap period is set to SWAP
         And sending the gifts when the swap period is set to WATCH
 
-        This runs after the period is set/responding to the user, so even if it fails, users
-        can still run /read, /receive themselves
+        The messages were queued in the outbox (in batch) in the same transaction the period
+        was set in, so they're still sent if the bot restarts. Progress is edited into the
+        set-period response (msg), and the admin is DMd when its done
         """
 
         if successfully_set_to == SwapPeriod.SWAP:
-            with Session(engine) as session:  # type: ignore[attr-defined]
-                users = session.query(SwapUser).all()
-                for user in users:
-                    logger.info(f"Sending {user.user_id} their giftees letter")
-                    if user.giftee_id is None:
-                        logger.info(
-                            f"Cannot send letter to {user.user_id} {user.name} as they have no giftee id"
-                        )
-                        continue
-                    try:
-                        letter_embed = read_giftee_letter(user.user_id)
-
-                        user_dm = await self.get_bot().fetch_user(user.user_id)
-                        await user_dm.send(embed=letter_embed)
-                        await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.exception(
-                            f"Error sending letter to user {user.user_id}: {e}",
-                            exc_info=True,
-                        )
+            kind = "letters"
         elif successfully_set_to == SwapPeriod.WATCH:
-            with Session(engine) as session:  # type: ignore[attr-defined]
-                users = session.query(SwapUser).all()
-                for user in users:
-                    logger.info(f"Sending {user.user_id} their santas gift")
-                    if user.giftee_id is None:
-                        logger.info(
-                            f"Cannot send gift to {user.user_id} {user.name} as they have no giftee id"
-                        )
-                        continue
-                    try:
-                        try:
-                            gift_embed = receive_gift_embed(
-                                user.user_id, raise_if_missing=True
-                            )
-                        except RuntimeError as e:
-                            logger.info(f"Error receiving gift for {user.user_id}: {e}")
-                            continue
-
-                        user_dm = await self.get_bot().fetch_user(user.user_id)
-                        await user_dm.send(embed=gift_embed)
-                        await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.exception(
-                            f"Error sending gift to user {user.user_id}: {e}",
-                            exc_info=True,
-                        )
+            kind = "gifts"
+        else:
+            return
+
+        self.get_outbox().notify()
+        task = asyncio.create_task(
+            _report_outbox_batch(interaction, batch, f"{msg}\nSending {kind}")
+        )
+        # keep a reference, so the task isn't garbage collected
+        _report_tasks.add(task)
+        task.add_done_callback(_report_tasks.discard)
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="set-period",
@@ -399,8 +685,13 @@ class Manage(discord.app_commands.Group):
             )
             return
 
+        batch: str | None = None
+        if settings.PERIOD_POST_HOOK:
+            batch = f"period-{new_period.name.lower()}-{int(time.time())}"
         try:
-            additional_message = Swap.set_swap_period(new_period)
+            additional_message = await run_db(
+                Swap.set_swap_period, new_period, outbox_batch=batch
+            )
         except Exception as e:
             logger.exception(e, exc_info=True)
             return await interaction.response.send_message(
@@ -412,9 +703,9 @@ class Manage(discord.app_commands.Group):
             msg += f"\n{additional_message}"
 
         await interaction.response.send_message(msg, ephemeral=True)
-        if settings.PERIOD_POST_HOOK:
+        if batch is not None:
             logger.info("Running period post hook")
-            await self._set_period_post_hook(interaction, new_period)
+            await self._set_period_post_hook(interaction, new_period, batch, msg)
         else:
             logger.info("Skipping period post hook")
 
@@ -447,7 +738,8 @@ class Manage(discord.app_commands.Group):
             "Updating usernames, this may take a few seconds...", ephemeral=True
         )
 
-        await update_usernames(guild)
+        result = await update_usernames(guild)
+        await interaction.followup.send(result.describe(), ephemeral=True)
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="match-users",
@@ -460,7 +752,7 @@ class Manage(discord.app_commands.Group):
         logger.info(f"Admin {interaction.user.id} matching users")
 
         try:
-            Swap.match_users()
+            await run_db(Swap.match_users)
         except Exception as e:
             logger.exception(e, exc_info=True)
             return await interaction.response.send_message(
@@ -488,7 +780,7 @@ class Manage(discord.app_commands.Group):
         logger.info(f"Admin {interaction.user.id} unmatching users")
 
         try:
-            Swap.unmatch_users()
+            await run_db(Swap.unmatch_users)
         except Exception as e:
             logger.exception(e, exc_info=True)
             return await interaction.response.send_message(
@@ -509,7 +801,7 @@ class Manage(discord.app_commands.Group):
         logger.info(f"Setting channel for swap to {channel}")
 
         try:
-            Swap.set_swap_channel(channel.id)
+            await run_db(Swap.set_swap_channel, channel.id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -532,7 +824,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            swap_info = Swap.get_swap()
+            swap_info = await run_db_read(Swap.get_swap)
             if swap_info.swap_channel_discord_id is None:
                 logger.info("No channel set for swap")
                 await interaction.response.send_message(
@@ -551,7 +843,7 @@ class Manage(discord.app_commands.Group):
             )
 
             # save this so that it can become a persistent view
-            Swap.save_join_button_message_id(msg.id)
+            await run_db(Swap.save_join_button_message_id, msg.id)
 
             await interaction.response.send_message(
                 f"Sent message to channel {channel}", ephemeral=True
@@ -584,7 +876,7 @@ class Manage(discord.app_commands.Group):
         assert interaction.guild is not None
 
         try:
-            ban_user(user_id)
+            await run_db(ban_user, user_id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -595,7 +887,7 @@ class Manage(discord.app_commands.Group):
         )
 
         try:
-            await _fix_connections_after_ban_or_leave(user_id, self.get_bot())
+            await _fix_connections_after_ban_or_leave(user_id, self.get_outbox())
         except (RuntimeError, AssertionError) as e:
             logger.exception(e, exc_info=True)
             # send message to person who ran the command
@@ -625,7 +917,7 @@ class Manage(discord.app_commands.Group):
         assert interaction.guild is not None
 
         try:
-            unban_user(user_id)
+            await run_db(unban_user, user_id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -652,7 +944,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            set_gift_done(member.id)
+            await run_db(set_gift_done, member.id)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -670,7 +962,7 @@ class Manage(discord.app_commands.Group):
             return
 
         try:
-            swap = Swap.get_swap()
+            swap = await run_db_read(Swap.get_swap)
         except Exception as e:
             logger.exception(e, exc_info=True)
             await interaction.response.send_message(f"Error: {e}", ephemeral=True)
@@ -687,64 +979,28 @@ class Manage(discord.app_commands.Group):
         assert isinstance(channel, discord.TextChannel) or channel is None
         embed.add_field(name="Channel", value=channel.mention if channel else "None")
 
-        all_users = list_users()
-        no_letters = havent_set_letter()
-        havent_submitted = havent_submitted_gift()
-        dont_have_parters = users_without_giftees()
-        dont_have_santas = users_without_santas()
-        not_done_watching = users_not_done_watching()
-        banned = Banned.list_banned()
+        counts = await run_db_read(swap_counts)
 
-        embed.add_field(name="Users in Swap", value=f"{len(all_users)}")
-        embed.add_field(name="Users without letters", value=f"{len(no_letters)}")
+        embed.add_field(name="Users in Swap", value=f"{counts.users}")
+        embed.add_field(name="Users without letters", value=f"{counts.without_letters}")
         embed.add_field(
             name="Active users (have letters)",
-            value=f"{len(all_users) - len(no_letters)}",
+            value=f"{counts.users - counts.without_letters}",
         )
         embed.add_field(
             name="Active users without gifts",
-            value=f"{len(havent_submitted)}",
+            value=f"{counts.without_gifts}",
         )
         embed.add_field(
             name="Active users not done watching",
-            value=f"{len(not_done_watching)}",
+            value=f"{counts.not_done_watching}",
         )
-        embed.add_field(name="Banned users", value=f"{len(banned)}")
+        embed.add_field(name="Banned users", value=f"{counts.banned}")
+        embed.add_field(name="Embed cache", value=embed_cache.stats(), inline=False)
 
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
-        report = f"""**{len(all_users)}** users are in the swap
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in all_users)}
-
-**{len(no_letters)}** users have not submitted letters
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in no_letters)}
-
-**{len(havent_submitted)}** users [who have letters] have not submitted gifts
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in havent_submitted)}
-
-**{len(not_done_watching)}** users [who have letters] have not set /done-watching
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in not_done_watching)}
-
-**{len(dont_have_parters)}** users [who have letters] do not have giftees
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in dont_have_parters)}
-
-**{len(dont_have_santas)}** users [who have letters] do not have santas
-
-{os.linesep.join(f'{user.user_id} {user.name}' for user in dont_have_santas)}
-
-**{len(banned)}** users are banned
-
-{os.linesep.join(f'{user.user_id}' for user in banned)}
-"""
-
-        with io.BytesIO() as f:
-            f.write(report.encode("utf-8"))
-            f.seek(0)
+        with await run_db_read(write_report) as f:
             await interaction.user.send(file=discord.File(f, "report.txt"))
 
     @discord.app_commands.command(  # type: ignore[arg-type]
@@ -763,138 +1019,142 @@ class Manage(discord.app_commands.Group):
             "randomize",  # as in, pick a random layout, don't use the "random" layout
         ] = "spectral",
         count: int = 1,
+        # graphs are rendered with seed, seed+1, ..., so the same seed gives the
+        # same (cached) graphs, and a different seed gives new ones
+        seed: int = 0,
     ) -> None:
         logger.info(f"User {interaction.user.id} revealing connections -- {format}")
 
         if await error_if_not_admin(interaction):
             return
 
-        all_users = list_users()
-        users_with_both = [
-            user for user in all_users if user.giftee_id and user.santa_id
-        ]
+        connections, id_to_names = await run_db_read(matched_users)
 
-        if len(users_with_both) == 0:
+        if len(connections) == 0:
             await interaction.response.send_message(
                 "Error: No users have both a giftee and a santa", ephemeral=True
             )
             return
 
-        await interaction.response.send_message(
-            f"Sending reveal to {interaction.user.display_name}", ephemeral=True
-        )
+        if format == "graph" and graph_layout not in GRAPH_LAYOUTS + ["randomize"]:
+            await interaction.response.send_message(
+                f"Error: Unknown graph layout {graph_layout}", ephemeral=True
+            )
+            return
 
-        id_to_names: dict[int, str] = {
-            user.user_id: user.name for user in users_with_both
-        }
+        # validate before responding, since a graph response is deferred
+        cycles: list[list[int]] | None = None
+        try:
+            cycles = decompose_cycles(connections)
+        except ValueError as e:
+            logger.exception(e, exc_info=True)
+            # the text report still works for a broken matching, which is when
+            # it's needed the most (to see whats wrong)
+            if format != "text":
+                await interaction.response.send_message(f"Error: {e}", ephemeral=True)
+                return
+            broken = e
+
+        if format == "graph":
+            # rendering can take a while, so this can't respond right away
+            await interaction.response.defer(ephemeral=True, thinking=True)
+        else:
+            await interaction.response.send_message(
+                f"Sending reveal to {interaction.user.display_name}", ephemeral=True
+            )
 
         bot = self.get_bot()
         user_obj = await bot.fetch_user(interaction.user.id)
 
+        digest = matching_hash(connections, id_to_names)
+        # the cache is on disk, so read/write it off the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, evict_stale, digest)
+
         if format == "text":
-            report = os.linesep.join(
-                f"{id_to_names.get(user.user_id, user.user_id)} is gifting to {id_to_names.get(user.giftee_id, user.giftee_id)} and is being gifted by {id_to_names.get(user.santa_id, user.santa_id)}"  # type: ignore[arg-type]
-                for user in users_with_both
+
+            def _report() -> bytes:
+                if cycles is None:
+                    # one line per user, in the order they joined
+                    return os.linesep.join(
+                        [
+                            f"Warning: the matching is broken ({broken}), so this isn't in gifting order"
+                        ]
+                        + [
+                            f"{id_to_names[user_id]} is gifting to {id_to_names.get(giftee_id, giftee_id)} and is being gifted by {id_to_names.get(santa_id, santa_id)}"
+                            for user_id, santa_id, giftee_id in connections
+                        ]
+                    ).encode("utf-8")
+                santas = {
+                    user_id: santa_id for user_id, santa_id, _giftee_id in connections
+                }
+                return os.linesep.join(
+                    f"{id_to_names[user_id]} is gifting to {id_to_names[cycle[(i + 1) % len(cycle)]]} and is being gifted by {id_to_names[santas[user_id]]}"
+                    for cycle in cycles
+                    for i, user_id in enumerate(cycle)
+                ).encode("utf-8")
+
+            data = await loop.run_in_executor(
+                None, cached_output, digest, "report.txt", _report
             )
-            with io.BytesIO() as f:
-                f.write(report.encode("utf-8"))
-                f.seek(0)
+            with io.BytesIO(data) as f:
                 await interaction.user.send(file=discord.File(f, "report.txt"))
 
         elif format == "pretty":
-            graph = nx.DiGraph()
-            for user in users_with_both:
-                assert user.giftee_id is not None
-                graph.add_edge(
-                    user.user_id,
-                    user.giftee_id,
-                )
 
-            # in case we had people who joined late, we need to check for multiple
-            # unconnected graphs
-            # iterate through the graph neighbours and create lists of each cycle
-            cycles = list(nx.simple_cycles(graph))
-            assert len(cycles) > 0, "No cycles found in graph"
-
-            results = []
-            for cycle in cycles:
-                names = []
-                assert len(cycle) > 0, "Empty cycle found in graph"
-                # add the first user
-                names.append(id_to_names.get(cycle[0]))
-                for from_user in cycle:
-                    # get the user this was sent to
-                    to_user_list = list(graph.neighbors(from_user))
-                    assert (
-                        len(to_user_list) == 1
-                    ), "More than one neighbour found when generating links"
-                    to_user = id_to_names.get(to_user_list[0])
-                    assert (
-                        to_user is not None
-                    ), f"No user found for ID {to_user_list[0]}"
-                    names.append(to_user)
-                results.append("➜".join([f"`{name}`" for name in names]))
-
-            report = (os.linesep * 2).join(results)
+            def _pretty() -> bytes:
+                assert cycles is not None
+                # in case we had people who joined late, there may be multiple cycles
+                return (
+                    (os.linesep * 2)
+                    .join(pretty_cycle(cycle, id_to_names) for cycle in cycles)
+                    .encode("utf-8")
+                )
 
+            data = await loop.run_in_executor(
+                None, cached_output, digest, "pretty.txt", _pretty
+            )
             await interaction.user.send("Copy-Paste this into Discord:")
-            with io.BytesIO() as f:
-                f.write(report.encode("utf-8"))
-                f.seek(0)
+            with io.BytesIO(data) as f:
                 await interaction.user.send(file=discord.File(f, "pretty.txt"))
 
         else:
-            for _g in range(count):
-                graph = nx.DiGraph()
-                plt.clf()
-                for user in users_with_both:
-                    assert user.giftee_id is not None
-                    graph.add_edge(
-                        filter_emoji(user.name),
-                        filter_emoji(id_to_names[user.giftee_id]),
-                        color="red",
-                    )
-
-                options = {
-                    "node_color": "blue",
-                    "node_size": 1,
-                    "edge_color": "#a9a9a9",
-                    "width": 3,
-                    "arrowstyle": "-|>",
-                    "arrowsize": 13,
-                    "font_size": 8,
-                    "font_color": "black",
-                }
+            edges = [
+                (
+                    filter_emoji(id_to_names[user_id]),
+                    filter_emoji(id_to_names[giftee_id]),
+                )
+                for user_id, _santa_id, giftee_id in connections
+            ]
+            graphs: list[tuple[str, int]] = []
+            filenames: set[str] = set()
+            for graph_seed in range(seed, seed + count):
+                layout: str = graph_layout
+                if layout == "randomize":
+                    layout = random.Random(graph_seed).choice(GRAPH_LAYOUTS)
+                # unseeded layouts are the same for every seed, only send them once
+                if (filename := graph_filename(layout, graph_seed)) in filenames:
+                    continue
+                filenames.add(filename)
+                graphs.append((layout, graph_seed))
+            logger.info(f"Rendering {len(graphs)} reveal graphs: {graphs}")
+            try:
+                images = await render_graphs(digest, edges, graphs)
+            except Exception as e:
+                logger.exception(e, exc_info=True)
+                await interaction.followup.send(f"Error: {e}", ephemeral=True)
+                return
 
-                func = {
-                    "circle": nx.circular_layout,
-                    "random": nx.random_layout,
-                    "kamada_kawai": nx.kamada_kawai_layout,
-                    "spring": nx.spring_layout,
-                    "spectral": nx.spectral_layout,
-                }
-                if graph_layout in func:
-                    layout_name = graph_layout
-                    pos = func[graph_layout](graph)
-                elif graph_layout == "randomize":
-                    chosen_func = random.choice(list(func.values()))
-                    layout_name = chosen_func.__name__
-                    pos = chosen_func(graph)
-                else:
-                    return await interaction.response.send_message(
-                        f"Error: Unknown graph layout {graph_layout}", ephemeral=True
-                    )
-                nx.draw_networkx(graph, pos, arrows=True, **options)
-                plt.box(False)
-                with io.BytesIO() as f:
-                    plt.savefig(
-                        f, pad_inches=0.1, transparent=False, bbox_inches="tight"
-                    )
-                    f.seek(0)
+            for (layout_name, _graph_seed), image in zip(graphs, images):
+                with io.BytesIO(image) as f:
                     await user_obj.send(
                         f"Reveal with {layout_name}",
                         file=discord.File(f, "reveal.png"),
                     )
+            await interaction.followup.send(
+                f"Sent {len(images)} reveal graphs to {interaction.user.display_name}",
+                ephemeral=True,
+            )
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="backup-database", description="Backup the database"
@@ -905,18 +1165,22 @@ class Manage(discord.app_commands.Group):
         if await error_if_not_admin(interaction):
             return
 
-        snapshot_database()
+        await interaction.response.defer(ephemeral=True)
 
-        files = Path(settings.BACKUP_DIR).glob("*.json")
-        latest = max(files, key=os.path.getmtime)
+        backup_path = await run_db(take_snapshot, full=True)
+        assert backup_path is not None
+        export_path = await run_db_read(export_snapshot, backup_path)
+        await run_db(record_export, backup_path, export_path)
 
-        await interaction.response.send_message(
+        await interaction.followup.send(
             "Saved database backup and JSON snapshot", ephemeral=True
         )
 
         # send the JSON export
-        with open(latest, "rb") as f:
-            await interaction.user.send(file=discord.File(f, latest.name))
+        with open(export_path, "rb") as f:
+            await interaction.user.send(
+                file=discord.File(f, os.path.basename(export_path))
+            )
 
     @discord.app_commands.command(  # type: ignore[arg-type]
         name="create-final-thoughts-thread",
@@ -931,7 +1195,7 @@ class Manage(discord.app_commands.Group):
             return
 
         bot = self.get_bot()
-        swap_info = Swap.get_swap()
+        swap_info = await run_db_read(Swap.get_swap)
         if swap_info.swap_channel_discord_id is None:
             logger.info("No channel set for swap")
             await interaction.response.send_message(
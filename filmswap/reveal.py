@@ -0,0 +1,243 @@
+"""
+Helpers for revealing who was gifting to who at the end of a swap
+
+Since everyone has exactly one santa and one giftee, the santa -> giftee
+connections are a permutation, so they split into disjoint cycles (usually
+just one, unless users were matched late with match-users)
+
+Graphs are rendered in a process pool, since layouts (especially kamada_kawai)
+can take a long time for large swaps, and would otherwise block the bot
+
+Outputs are cached in REVEAL_CACHE_DIR, in a directory named after a hash of the
+matching, so running reveal again (until the matching or names change) is instant.
+The cache functions do blocking file I/O, so the bot runs them in an executor
+"""
+
+import io
+import os
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable
+
+from logzero import logger  # type: ignore[import]
+
+from .settings import settings
+
+# (user_id, santa_id, giftee_id)
+Connection = tuple[int, int, int]
+
+
+def decompose_cycles(connections: Iterable[Connection]) -> list[list[int]]:
+    """
+    Splits the connections into cycles of user ids, each starting at the first user
+    (in the order given) in that cycle, and following giftees from there
+
+    Raises ValueError if the connections aren't a valid set of cycles, i.e. someone is
+    gifting to a user who isn't in the swap, or santa/giftee ids don't agree
+    """
+    giftees: dict[int, int] = {}
+    santas: dict[int, int] = {}
+    for user_id, santa_id, giftee_id in connections:
+        giftees[user_id] = giftee_id
+        santas[user_id] = santa_id
+
+    for user_id, giftee_id in giftees.items():
+        if giftee_id not in giftees:
+            raise ValueError(
+                f"User {user_id} is gifting to {giftee_id}, who isn't matched in the swap"
+            )
+        if santas[giftee_id] != user_id:
+            raise ValueError(
+                f"User {user_id} is gifting to {giftee_id}, but their santa is {santas[giftee_id]}"
+            )
+
+    # since every giftee has exactly one santa (checked above), following
+    # giftees from any user always leads back to that user
+    cycles: list[list[int]] = []
+    visited: set[int] = set()
+    for start in giftees:
+        if start in visited:
+            continue
+        cycle = []
+        user_id = start
+        while user_id not in visited:
+            visited.add(user_id)
+            cycle.append(user_id)
+            user_id = giftees[user_id]
+        cycles.append(cycle)
+    return cycles
+
+
+def pretty_cycle(cycle: list[int], names: dict[int, str]) -> str:
+    """
+    `A`➜`B`➜`C`➜`A`, to paste into discord
+    """
+    return "➜".join(f"`{names[user_id]}`" for user_id in cycle + cycle[:1])
+
+
+GRAPH_LAYOUTS = ["circle", "random", "kamada_kawai", "spring", "spectral"]
+# layouts which look different for each seed, the others are always the same
+SEEDED_LAYOUTS = {"random", "spring"}
+
+
+def render_graph(edges: list[tuple[str, str]], layout: str, seed: int) -> bytes:
+    """
+    draws the (santa name, giftee name) edges with a networkx layout, returning PNG bytes
+
+    this runs in a worker process, so it only takes/returns plain data
+    """
+    import matplotlib  # type: ignore[import]
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt  # type: ignore[import]
+    import networkx as nx  # type: ignore[import]
+
+    graph = nx.DiGraph()
+    plt.clf()
+    for santa, giftee in edges:
+        graph.add_edge(santa, giftee, color="red")
+
+    options = {
+        "node_color": "blue",
+        "node_size": 1,
+        "edge_color": "#a9a9a9",
+        "width": 3,
+        "arrowstyle": "-|>",
+        "arrowsize": 13,
+        "font_size": 8,
+        "font_color": "black",
+    }
+
+    func = {
+        "circle": nx.circular_layout,
+        "random": nx.random_layout,
+        "kamada_kawai": nx.kamada_kawai_layout,
+        "spring": nx.spring_layout,
+        "spectral": nx.spectral_layout,
+    }
+    if layout in SEEDED_LAYOUTS:
+        pos = func[layout](graph, seed=seed)
+    else:
+        pos = func[layout](graph)
+    nx.draw_networkx(graph, pos, arrows=True, **options)
+    plt.box(False)
+    with io.BytesIO() as f:
+        plt.savefig(f, pad_inches=0.1, transparent=False, bbox_inches="tight")
+        return f.getvalue()
+
+
+_render_pool: ProcessPoolExecutor | None = None
+
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    if _render_pool is None:
+        # spawn, since forking a process with running threads (the db executors) isn't safe
+        _render_pool = ProcessPoolExecutor(
+            max_workers=settings.REVEAL_RENDER_PROCESSES or None,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _render_pool
+
+
+def graph_filename(layout: str, seed: int) -> str:
+    if layout in SEEDED_LAYOUTS:
+        return f"graph-{layout}-{seed}.png"
+    return f"graph-{layout}.png"
+
+
+async def render_graphs(
+    digest: str, edges: list[tuple[str, str]], graphs: list[tuple[str, int]]
+) -> list[bytes]:
+    """
+    render a graph for each (layout, seed), in parallel. graphs already in the
+    reveal cache for this matching (digest) aren't re-rendered, and since unseeded
+    layouts look the same for every seed, each file is only rendered once
+    """
+    loop = asyncio.get_running_loop()
+
+    async def _render(layout: str, seed: int) -> bytes:
+        name = graph_filename(layout, seed)
+        cached = await loop.run_in_executor(None, read_cached, digest, name)
+        if cached is not None:
+            return cached
+        image = await loop.run_in_executor(
+            _get_render_pool(), render_graph, edges, layout, seed
+        )
+        await loop.run_in_executor(None, write_cached, digest, name, image)
+        return image
+
+    # graph filename -> the (layout, seed) to render it with
+    unique = {graph_filename(layout, seed): (layout, seed) for layout, seed in graphs}
+    images = await asyncio.gather(*(_render(*graph) for graph in unique.values()))
+    rendered = dict(zip(unique, images))
+    return [rendered[graph_filename(layout, seed)] for layout, seed in graphs]
+
+
+def matching_hash(connections: Iterable[Connection], names: dict[int, str]) -> str:
+    """
+    hash of the (user_id, giftee_id, name) for everyone in the matching, which
+    is everything the reveal outputs depend on
+    """
+    h = hashlib.sha256()
+    for user_id, _santa_id, giftee_id in sorted(connections):
+        h.update(f"{user_id}\t{giftee_id}\t{names[user_id]}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_path(digest: str, name: str) -> Path:
+    return Path(settings.REVEAL_CACHE_DIR) / digest / name
+
+
+def read_cached(digest: str, name: str) -> bytes | None:
+    path = _cache_path(digest, name)
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    logger.info(f"Using cached reveal output {path}")
+    return data
+
+
+def write_cached(digest: str, name: str, data: bytes) -> None:
+    path = _cache_path(digest, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temp file and rename, so a partially written file is never read.
+    # each writer gets its own temp file, since executor threads share a pid
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False
+    ) as f:
+        f.write(data)
+    try:
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
+def cached_output(digest: str, name: str, build: Callable[[], bytes]) -> bytes:
+    """
+    the cached output for this matching, building (and caching) it if its not cached
+    """
+    if (data := read_cached(digest, name)) is None:
+        data = build()
+        write_cached(digest, name, data)
+    return data
+
+
+def evict_stale(digest: str) -> None:
+    """
+    remove cached outputs for any other matching
+    """
+    cache_dir = Path(settings.REVEAL_CACHE_DIR)
+    if not cache_dir.exists():
+        return
+    for path in cache_dir.iterdir():
+        if path.is_dir() and path.name != digest:
+            logger.info(f"Removing stale reveal cache {path}")
+            shutil.rmtree(path, ignore_errors=True)
@@ -8,16 +8,82 @@ class Environment(str, Enum):
     DEVELOPMENT = "dev"
 
 
+class SqliteProfile(str, Enum):
+    # sqlite defaults, rollback journal and a full fsync on every commit
+    LEGACY = "legacy"
+    # WAL, so reads don't wait on writes. synchronous=NORMAL in WAL mode can't corrupt
+    # the database, but a power loss/OS crash may lose the last few commits
+    SAFE = "safe"
+    # no fsyncs at all and a large mmap, only use this if you have frequent backups
+    FAST = "fast"
+
+
+# pragmas applied to each new connection, for each profile
+SQLITE_PROFILE_PRAGMAS: dict[SqliteProfile, dict[str, str | int]] = {
+    SqliteProfile.LEGACY: {},
+    SqliteProfile.SAFE: {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        # negative is in KiB, so 16MB
+        "cache_size": -16000,
+        "temp_store": "MEMORY",
+        "mmap_size": 0,
+    },
+    SqliteProfile.FAST: {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "busy_timeout": 5000,
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+        "mmap_size": 256 * 1024 * 1024,
+    },
+}
+
+
 class Settings(BaseSettings):
     SQLITEDB_PATH: str = "filmswap.db"
     SQL_ECHO: bool = False
+    SQLITE_PROFILE: SqliteProfile = SqliteProfile.SAFE
     GUILD_ID: int = -1
     ALLOWED_ROLES: list[str] = []
     ENVIRONMENT: str = Environment.DEVELOPMENT
     BACKUP_DIR: str = "backups"
+    # hours between snapshots (only the changes since the last one), 0 to disable
+    SNAPSHOT_INTERVAL: float = 6
+    # take a full snapshot after this many deltas
+    SNAPSHOT_FULL_EVERY: int = 28
+    # snapshot retention: keep the most recent, the last each day for this many days,
+    # and the last each month for this many months (0 to keep them forever)
+    SNAPSHOT_KEEP_RECENT: int = 10
+    SNAPSHOT_KEEP_DAILY: int = 31
+    SNAPSHOT_KEEP_MONTHLY: int = 0
     BOT_NAME: str = "FilmSwap"
     APP_LOCALE: str = "film"
     PERIOD_POST_HOOK: bool = True
+    # how many DMs the period post hook sends at once, and how many times to retry a rate limited DM
+    DM_FANOUT_CONCURRENCY: int = 5
+    DM_FANOUT_MAX_RETRIES: int = 5
+    # outbox messages which fail for other reasons are retried this many times, with a backoff
+    OUTBOX_MAX_ATTEMPTS: int = 5
+    # seconds between checking the outbox for messages that are due to be retried
+    OUTBOX_POLL_INTERVAL: int = 30
+    # names are kept up to date from member update events, these are batched for this many seconds
+    MEMBER_UPDATE_DEBOUNCE: float = 5
+    # each user can run DM commands (>letter, >write-santa...) this many times in a row,
+    # then this many times per minute (per command), 0 to disable
+    DM_COMMAND_BURST: int = 3
+    DM_COMMAND_PER_MINUTE: float = 6
+    # >letter edits sent within this many seconds of each other are only saved once
+    DM_COMMAND_DEBOUNCE: float = 3
+    # hours between full username sweeps, which catch any events missed while the bot was down
+    USERNAME_RECONCILE_INTERVAL: int = 24 * 7
+    # max number of user contexts/rendered letter and gift embeds kept in memory
+    EMBED_CACHE_SIZE: int = 10000
+    # processes used to render reveal graphs, 0 to use one per CPU
+    REVEAL_RENDER_PROCESSES: int = 0
+    # reveal outputs are cached here, until the matching changes
+    REVEAL_CACHE_DIR: str = "reveal_cache"
     FILMSWAP_TOKEN: str
     BACKUPS_DIR: str = "backups"
     # can set these to empty strings to disable
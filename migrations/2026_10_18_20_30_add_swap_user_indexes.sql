@@ -0,0 +1,19 @@
+-- SQLite migration file
+-- Add indexes for the santa/giftee lookups, and make swap_users.user_id unique
+--
+-- if creating the unique index fails, a user has more than one row, find them with:
+-- SELECT user_id, COUNT(*) FROM swap_users GROUP BY user_id HAVING COUNT(*) > 1;
+
+BEGIN TRANSACTION;
+
+-- replace the non-unique user_id index with a unique one
+DROP INDEX IF EXISTS ix_swap_users_user_id;
+CREATE UNIQUE INDEX ix_swap_users_user_id ON swap_users (user_id);
+
+CREATE INDEX IF NOT EXISTS ix_swap_users_santa_id ON swap_users (santa_id);
+CREATE INDEX IF NOT EXISTS ix_swap_users_giftee_id ON swap_users (giftee_id);
+
+-- users who have set a letter, used when matching users
+CREATE INDEX IF NOT EXISTS ix_swap_users_with_letter ON swap_users (santa_id, user_id) WHERE letter IS NOT NULL;
+
+COMMIT;